@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# Benchmarks of process() over generated outline layers.
+#
+# Every configuration (point count, output mode, writer, XML backend) runs
+# in its own Python process, so the peak RSS reported is that of the
+# configuration alone. Phases are timed separately:
+#   load    - parsing the --sample file, or generating the canvas
+#   process - building the rig graph and picking the shared nodes
+#   lower   - putting the graph into the tree (tree writer only)
+#   write   - tree.write(), or writesif() for the stream writer
+# Output goes to a byte counter, not to disk. Configurations predicted to
+# write more than --max-size are skipped.
+#
+#   python3 benchmarks/bench_process.py
+#   python3 benchmarks/bench_process.py --points 5,500 --modes dedup --json
+#   python3 benchmarks/bench_process.py --sample samples/yoyospline.sif
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import resource
+import subprocess
+import importlib.util
+
+freeformdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+		'..', 'freeform')
+sys.path.insert(0, freeformdir)
+
+# Picked from FREEFORM_DEFORM_XML, which runchild() sets for each backend
+import xmlbackend
+from xmlbackend import ET
+
+def loadfreeform():
+	"Import freeform-deform.py, whose name is not a module name"
+	spec = importlib.util.spec_from_file_location('freeform_deform',
+			os.path.join(freeformdir, 'freeform-deform.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def makecanvas(ff, points):
+	"Canvas with one closed outline layer of given point count, a wobbly circle"
+	root = ET.Element('canvas', {'version': '0.9', 'width': '480',
+			'height': '270', 'view-box': '-4.000000 2.250000 4.000000 -2.250000',
+			'fps': '24.000', 'begin-time': '0f', 'end-time': '5s'})
+	ET.SubElement(root, 'name').text = 'Benchmark'
+	layer = ff.xmldup_r(ff.nodedict['layer_outline'])
+	layer.set('desc', 'Benchmark %d' % points)
+	bline = ff.findparam(layer, 'bline').find('bline')
+	for entry in bline.findall('entry'):
+		bline.remove(entry)
+	for i in range(points):
+		a = 2.0 * math.pi * i / points
+		r = 2.0 + 0.25 * math.sin(7.0 * a)
+		t = (-math.sin(a) * 0.5, math.cos(a) * 0.5)
+		bline.append(ff.bline_entry((r * math.cos(a), r * math.sin(a)), t, t)[0])
+	root.append(layer)
+	return ET.ElementTree(root)
+
+class Counter(object):
+	"Binary file object that only counts what is written to it"
+	def __init__(self):
+		self.size = 0
+	def write(self, data):
+		self.size += len(data)
+		return len(data)
+	def writable(self):
+		return True
+	def readable(self):
+		return False
+	def seekable(self):
+		return False
+	def flush(self):
+		pass
+	closed = False
+
+def runconfig(points, mode, writer, maxsize, backend, sample=None):
+	"Run one configuration in this process, returning its measurements"
+	result = {'points': points, 'mode': mode, 'writer': writer,
+			'backend': backend}
+	if backend == 'lxml' and not xmlbackend.lxml:
+		result['missing'] = True
+		return result
+	ff = loadfreeform()
+
+	start = time.time()
+	if sample:
+		f = ff.opensif(sample)
+		tree = xmlbackend.parse(f)
+		f.close()
+		result['points'] = len(ff.getblinepoints(ff.defaultlayers(tree)[0]))
+	else:
+		tree = makecanvas(ff, points)
+	result['load'] = time.time() - start
+
+	start = time.time()
+	ff.process(tree, mode, True)
+	result['process'] = time.time() - start
+	nodes, size = ff.predictsize(tree.getroot())
+	result['nodes'] = nodes
+	if size > maxsize:
+		result['skipped'] = size
+		return result
+
+	out = Counter()
+	if writer == 'tree':
+		start = time.time()
+		ff.lowertree(tree.getroot())
+		result['lower'] = time.time() - start
+		start = time.time()
+		tree.write(out)
+	else:
+		start = time.time()
+		ff.writesif(tree, out)
+	result['write'] = time.time() - start
+	result['bytes'] = out.size
+	result['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	return result
+
+def runchild(points, mode, writer, maxsize, backend, sample=None):
+	"Run one configuration in a new process"
+	env = dict(os.environ, FREEFORM_DEFORM_XML=backend)
+	config = json.dumps([points, mode, writer, maxsize, backend, sample])
+	output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+			'--child', config], env=env)
+	return json.loads(output.decode('utf-8'))
+
+def formatrow(r):
+	def seconds(key):
+		return '%8.3f' % r[key] if key in r else '%8s' % '-'
+	if 'missing' in r:
+		return '%6d %-7s %-6s %-6s  skipped, lxml is not installed' % (
+				r['points'], r['mode'], r['writer'], r['backend'])
+	if 'skipped' in r:
+		return '%6d %-7s %-6s %-6s %8.3f %8.3f %8s %8s  skipped, predicted %d MB' % (
+				r['points'], r['mode'], r['writer'], r['backend'], r['load'],
+				r['process'], '-', '-', r['skipped'] >> 20)
+	return '%6d %-7s %-6s %-6s %s %s %s %s %8d %12d %10d' % (r['points'],
+			r['mode'], r['writer'], r['backend'], seconds('load'),
+			seconds('process'), seconds('lower'), seconds('write'),
+			r['maxrss'] >> 20, r['bytes'], r['nodes'])
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark process() "
+			"across spline sizes, output modes and writers")
+	parser.add_argument('--points', default='5,50,500,2000,10000',
+			help="comma separated point counts (default 5,50,500,2000,10000)")
+	parser.add_argument('--modes', default='shared,dedup,inline',
+			help="comma separated output modes (default shared,dedup,inline)")
+	parser.add_argument('--writers', default='tree,stream',
+			help="comma separated writers, tree and/or stream (default both)")
+	parser.add_argument('--backends', default='etree,lxml',
+			help="comma separated XML backends, etree and/or lxml (default "
+			"both, lxml only when installed)")
+	parser.add_argument('--sample', metavar='FILE',
+			help="process this SIF file instead of generated canvases, "
+			"--points is then unused")
+	parser.add_argument('--max-size', type=int, default=256, metavar='MB',
+			help="skip configurations predicted to write more (default 256)")
+	parser.add_argument('--json', action='store_true',
+			help="print one JSON object per configuration")
+	parser.add_argument('--child', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		print(json.dumps(runconfig(*json.loads(args.child))))
+		raise SystemExit
+
+	if not args.json:
+		print('%6s %-7s %-6s %-6s %8s %8s %8s %8s %8s %12s %10s' % ('points',
+				'mode', 'writer', 'xml', 'load', 'process', 'lower', 'write',
+				'RSS MB', 'bytes', 'nodes'))
+	points = [0] if args.sample else [int(p) for p in args.points.split(',')]
+	sample = os.path.abspath(args.sample) if args.sample else None
+	for n in points:
+		for mode in args.modes.split(','):
+			for writer in args.writers.split(','):
+				for backend in args.backends.split(','):
+					r = runchild(n, mode, writer, args.max_size << 20, backend,
+							sample)
+					print(json.dumps(r, sort_keys=True) if args.json
+							else formatrow(r))
+					sys.stdout.flush()
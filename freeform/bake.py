@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# Numeric evaluation of the deformation built by process(), used to bake
+# the rig into plain vectors, and of animated values sampled over frames.
+# All functions work on NumPy arrays and broadcast over any leading
+# dimensions, so a batch of frames is evaluated in one call.
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+def reciprocal(x, epsilon=0.000001, infinite=999999.0):
+	"Reciprocal convert node: 1/x, or +-infinite when x is within epsilon of 0"
+	x = np.asarray(x, dtype=float)
+	small = np.abs(x) < epsilon
+	safe = np.where(small, 1.0, x)
+	return np.where(small, np.where(x < 0, -infinite, infinite), 1.0 / safe)
+
+def windowmap(points, window):
+	"Map points (..., n, 2) into the window (..., 4) as left, bottom, right, top"
+	left, bottom, right, top = np.moveaxis(window, -1, 0)
+	x = (points[..., 0] - left[..., None]) * reciprocal(right - left)[..., None]
+	y = points[..., 1] - ((bottom + top) * 0.5)[..., None]
+	return x, y
+
+def segmentpoints(start, end, x, y):
+	"Place window coordinates (..., n) in the frame of segment start-end (..., 2)"
+	d = end - start
+	length = np.hypot(d[..., 0], d[..., 1])
+	i = d * reciprocal(length)[..., None]
+	j = np.stack((-i[..., 1], i[..., 0]), axis=-1)
+	return (start[..., None, :] + i[..., None, :] * (x * length[..., None])[..., None]
+			+ j[..., None, :] * y[..., None])
+
+def blend(a, b, t):
+	"Blend vectors (..., n, 2) by t (..., n): a*(1-t) + b*t"
+	return a * (1.0 - t)[..., None] + b * t[..., None]
+
+def deform(points, window, controls):
+	"""Deform bline points with a quadratic control curve
+
+	points is (..., n, 2), window (..., 4) and controls (..., 3, 2) holding
+	P0, P1 and P2. Returns the deformed vertices and their two tangents,
+	each (..., n, 2), as the graph built by process() computes them.
+	"""
+	points = np.asarray(points, dtype=float)
+	window = np.asarray(window, dtype=float)
+	controls = np.asarray(controls, dtype=float)
+	x, y = windowmap(points, window)
+	segment01 = segmentpoints(controls[..., 0, :], controls[..., 1, :], x, y)
+	segment12 = segmentpoints(controls[..., 1, :], controls[..., 2, :], x, y)
+
+	# Each curve runs from a point to the next one, wrapping around
+	x_next = np.roll(x, -1, axis=-1)
+	segment01_next = np.roll(segment01, -1, axis=-2)
+	segment12_next = np.roll(segment12, -1, axis=-2)
+	t_mid = (x + x_next) * 0.5
+
+	startpoint = blend(segment01, segment12, x)
+	endpoint = blend(segment01_next, segment12_next, x_next)
+	midpoint = blend((segment01 + segment01_next) * 0.5,
+			(segment12 + segment12_next) * 0.5, t_mid)
+	controlpoint = (midpoint * 4.0 - (startpoint + endpoint)) * 0.5
+
+	tangent1 = (startpoint - np.roll(controlpoint, 1, axis=-2)) * 2.0
+	tangent2 = (controlpoint - startpoint) * 2.0
+	return startpoint, tangent1, tangent2
+
+def waypointslopes(keys, values, kind):
+	"Slope in value per second at each waypoint for one interpolation kind"
+	h = np.diff(keys)
+	delta = np.diff(values, axis=0) / h[:, None]
+	if kind in ('halt', 'ease'):
+		return np.zeros_like(values)
+	# Catmull-Rom slopes, one-sided at both ends
+	slopes = np.empty_like(values)
+	slopes[0] = delta[0]
+	slopes[-1] = delta[-1]
+	slopes[1:-1] = (values[2:] - values[:-2]) / (keys[2:] - keys[:-2])[:, None]
+	if kind == 'clamped':
+		# No overshoot: flat where a component turns around
+		turn = np.zeros(values.shape, dtype=bool)
+		turn[1:-1] = delta[:-1] * delta[1:] <= 0
+		slopes[turn] = 0.0
+	return slopes
+
+def interpolate(keys, values, befores, afters, times):
+	"""Sample an animated value node at times, all in seconds
+
+	keys (k,) are the waypoint times, values (k, ...) their values, befores
+	and afters their Synfig interpolations. Each span between waypoints is a
+	cubic Hermite curve: linear, halt (ease) and constant follow Synfig, auto
+	(TCB) uses Catmull-Rom slopes, ignoring tension, continuity and bias, and
+	clamped flattens them at turning points. Returns (len(times), ...) values.
+	"""
+	keys = np.asarray(keys, dtype=float)
+	values = np.asarray(values, dtype=float)
+	times = np.asarray(times, dtype=float)
+	shape = values.shape[1:]
+	values = values.reshape(len(keys), -1)
+	if len(keys) == 1:
+		return np.broadcast_to(values[0], times.shape + shape).copy()
+
+	order = np.argsort(keys, kind='stable')
+	keys = keys[order]
+	values = values[order]
+	befores = [befores[i] for i in order]
+	afters = [afters[i] for i in order]
+
+	h = np.diff(keys)
+	delta = np.diff(values, axis=0) / h[:, None]
+	slopes = {}
+	for kind in set(befores) | set(afters):
+		if kind not in ('linear', 'constant'):
+			slopes[kind] = waypointslopes(keys, values, kind)
+	# Slope leaving each span start and entering each span end
+	m0 = np.array([delta[i] if kind in ('linear', 'constant')
+			else slopes[kind][i] for i, kind in enumerate(afters[:-1])])
+	m1 = np.array([delta[i] if kind in ('linear', 'constant')
+			else slopes[kind][i + 1] for i, kind in enumerate(befores[1:])])
+	constant = np.array([a == 'constant' or b == 'constant'
+			for a, b in zip(afters[:-1], befores[1:])])
+
+	span = np.clip(np.searchsorted(keys, times, side='right') - 1, 0, len(h) - 1)
+	u = np.clip((times - keys[span]) / h[span], 0.0, 1.0)[:, None]
+	u2 = u * u
+	u3 = u2 * u
+	p0 = values[span]
+	p1 = values[span + 1]
+	result = ((2 * u3 - 3 * u2 + 1) * p0 + (u3 - 2 * u2 + u) * h[span, None] * m0[span]
+			+ (-2 * u3 + 3 * u2) * p1 + (u3 - u2) * h[span, None] * m1[span])
+	hold = constant[span][:, None]
+	result = np.where(hold, np.where(u < 1.0, p0, p1), result)
+	return result.reshape(times.shape + shape)
@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# On-disk cache of the rig fragments built by process().
+#
+# Entries are JSON files in one directory, named by the digest of what
+# they were built from. Loading an entry touches it, so the modification
+# times order the entries by last use, and storing one evicts the least
+# recently used ones until the directory fits its size limit. Entries are
+# written to a temporary file and renamed, so processes sharing the
+# directory never read a partial one.
+
+import os
+import json
+import hashlib
+import tempfile
+
+def digest(parts):
+	"Key of the entry built from a list of strings"
+	h = hashlib.sha256()
+	for part in parts:
+		data = part.encode('utf-8')
+		h.update(('%d:' % len(data)).encode('ascii'))
+		h.update(data)
+	return h.hexdigest()
+
+def entrypath(directory, key):
+	return os.path.join(directory, key + '.json')
+
+def load(directory, key):
+	"The entry stored under key, or None"
+	path = entrypath(directory, key)
+	try:
+		with open(path, 'rb') as f:
+			entry = json.loads(f.read().decode('utf-8'))
+		os.utime(path, None)
+	except (IOError, OSError, ValueError):
+		return None
+	return entry
+
+def store(directory, key, entry, limit):
+	"Store entry under key, then evict entries until the directory fits limit bytes"
+	try:
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(json.dumps(entry).encode('utf-8'))
+		os.replace(temp, entrypath(directory, key))
+	except (IOError, OSError) as e:
+		print("cache: Cannot store the entry in %s: %s" % (directory, e))
+		return
+	evict(directory, limit)
+
+def evict(directory, limit):
+	"Remove the least recently used entries until the rest fit limit bytes"
+	entries = []
+	for name in os.listdir(directory):
+		if not name.endswith('.json'):
+			continue
+		path = os.path.join(directory, name)
+		try:
+			stat = os.stat(path)
+		except OSError:
+			continue
+		entries.append((stat.st_mtime, stat.st_size, path))
+	total = sum(size for mtime, size, path in entries)
+	for mtime, size, path in sorted(entries):
+		if total <= limit:
+			break
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		total -= size
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# Thin client of the freeform-deform.py --serve daemon, run by plugin.xml.
+#
+# The command line and working directory are sent as JSON over a Unix
+# socket, and the daemon answers with the exit status and output of the
+# run once the file is written. Only the standard library modules needed
+# for that are imported, so starting the client costs little. Without a
+# daemon listening, freeform-deform.py is run in its place.
+
+import os
+import sys
+import json
+import stat
+import socket
+
+def socketpath():
+	"Unix socket the daemon listens on, FREEFORM_DEFORM_SOCKET if set"
+	if os.environ.get('FREEFORM_DEFORM_SOCKET'):
+		return os.environ['FREEFORM_DEFORM_SOCKET']
+	directory = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+	return os.path.join(directory, 'freeform-deform-%d.sock' % os.getuid())
+
+def request(argv, path=None):
+	"""Run a command line on the daemon, returning (exit status, output)
+
+	Returns None when no daemon of this user is listening.
+	"""
+	if not hasattr(socket, 'AF_UNIX'):
+		return None
+	path = path or socketpath()
+	# Any user can make the socket in /tmp first, only trust our own daemon
+	try:
+		info = os.stat(path)
+	except OSError:
+		return None
+	if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+		sys.stderr.write("request: Not using %s, it isn't a socket of this "
+				"user\n" % path)
+		return None
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		client.connect(path)
+	except (IOError, OSError):
+		client.close()
+		return None
+	try:
+		client.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode('utf-8'))
+		client.shutdown(socket.SHUT_WR)
+		data = []
+		while True:
+			chunk = client.recv(65536)
+			if not chunk:
+				break
+			data.append(chunk)
+	finally:
+		client.close()
+	if not data:
+		return 1, "request: The daemon closed the connection\n"
+	reply = json.loads(b''.join(data).decode('utf-8'))
+	return reply['status'], reply['output']
+
+if __name__ == "__main__":
+	reply = request(sys.argv[1:])
+	if reply is None:
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+				'freeform-deform.py')
+		os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
+	status, output = reply
+	sys.stdout.write(output)
+	sys.exit(status)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# Evaluation of the value-node graph of a SIF canvas without Synfig.
+#
+# compilegraph() walks the value nodes reachable from a list of outputs and
+# turns them into a program: every distinct node gets a slot in a register
+# array, and the convert nodes are grouped by depth and type so each group
+# runs as one NumPy operation over all its nodes. Exported values are found
+# through the canvas defs, and inline copies sharing a guid are compiled
+# once, so inline, shared and dedup outputs give the same program. run()
+# evaluates a program over a batch of frames or input values.
+#
+# Every value is held as two floats: vectors as x, y, reals, angles (in
+# degrees) and bools in the first one.
+
+import sys
+import time
+
+import bake
+import xmlbackend
+
+np = bake.np
+
+def canvasdefs(root):
+	"Map the ids of the values exported in the canvas to their elements"
+	defs_section = root.find('defs')
+	if defs_section is None:
+		return {}
+	return dict((e.get('id'), e) for e in defs_section)
+
+def linkvalue(elem, link, ids):
+	"Find the value node linked from elem, inline or by exported id"
+	if link in elem.attrib:
+		return ids[elem.get(link).lstrip(':')]
+	return elem.find(link)[0]
+
+def usevalue(elem, ids):
+	"Find the value node held by a param or bline entry"
+	if 'use' in elem.attrib:
+		return ids[elem.get('use').lstrip(':')]
+	return elem[0]
+
+def parsetime(text, fps):
+	"Convert a SIF time string like '1s 24f' to seconds, bare numbers are frames"
+	units = {'h': 3600.0, 'm': 60.0, 's': 1.0}
+	seconds = 0.0
+	for token in text.replace(',', ' ').split():
+		try:
+			if token[-1] in units:
+				seconds += float(token[:-1]) * units[token[-1]]
+			elif token[-1] == 'f':
+				seconds += float(token[:-1]) / fps
+			else:
+				seconds += float(token) / fps
+		except (ValueError, ZeroDivisionError):
+			print("parsetime: Cannot read time '%s'" % text)
+			raise SystemExit
+	return seconds
+
+def constantvalue(elem):
+	"Read a constant value node as two floats, None if it is not one"
+	if elem.tag in ('real', 'angle', 'integer', 'time'):
+		return (float(elem.get('value', '0').rstrip('s')), 0.0)
+	elif elem.tag == 'bool':
+		return (1.0 if elem.get('value') == 'true' else 0.0, 0.0)
+	elif elem.tag == 'vector':
+		return (float(elem.find('x').text), float(elem.find('y').text))
+	return None
+
+def radial(radius, theta):
+	angle = np.radians(theta[..., 0])
+	return np.stack((radius[..., 0] * np.cos(angle),
+			radius[..., 0] * np.sin(angle)), axis=-1)
+
+def column(values):
+	"Put reals (...) back into the two float layout"
+	return np.stack((values, np.zeros_like(values)), axis=-1)
+
+# Links read by each convert node, in the order its operation takes them
+operations = {
+	'add': (('lhs', 'rhs', 'scalar'),
+			lambda lhs, rhs, scalar: (lhs + rhs) * scalar[..., :1]),
+	'subtract': (('lhs', 'rhs', 'scalar'),
+			lambda lhs, rhs, scalar: (lhs - rhs) * scalar[..., :1]),
+	'scale': (('link', 'scalar'),
+			lambda link, scalar: link * scalar[..., :1]),
+	'composite': (('x', 'y'),
+			lambda x, y: np.stack((x[..., 0], y[..., 0]), axis=-1)),
+	'radial_composite': (('radius', 'theta'), radial),
+	'reciprocal': (('link', 'epsilon', 'infinite'),
+			lambda link, epsilon, infinite: column(bake.reciprocal(
+				link[..., 0], epsilon[..., 0], infinite[..., 0]))),
+	'vectorlength': (('vector',),
+			lambda vector: column(np.hypot(vector[..., 0], vector[..., 1]))),
+	'vectorx': (('vector',), lambda vector: column(vector[..., 0])),
+	'vectory': (('vector',), lambda vector: column(vector[..., 1])),
+	'reference': (('link',), lambda link: link),
+}
+
+class Program(object):
+	"Compiled value-node graph, see compilegraph()"
+	__slots__ = ('size', 'constants', 'animated', 'steps', 'outputs', 'names',
+			'fps')
+
+def compilegraph(root, outputs, ids=None):
+	"""Compile the value nodes in outputs and all the nodes they link to
+
+	root is the canvas holding the defs, outputs a list of value node
+	elements. The program evaluates to one value per output.
+	"""
+	if np is None:
+		print("compilegraph: NumPy is required to evaluate the graph")
+		raise SystemExit
+	if ids is None:
+		ids = canvasdefs(root)
+	exported = dict((e, name) for name, e in ids.items())
+
+	slots = {}
+	constants = []
+	animated = []
+	nodes = []
+	levels = []
+	names = {}
+
+	# Keyed by the elements themselves rather than their id(): lxml makes
+	# element objects on access, an id can be reused once one is dropped
+	def key(elem):
+		if elem in exported or elem.get('guid') is None:
+			return elem
+		return elem.get('guid')
+
+	def compilenode(elem):
+		"Give elem a slot after the nodes it links to, without recursing"
+		stack = [(elem, False)]
+		while stack:
+			elem, ready = stack.pop()
+			k = key(elem)
+			if k in slots and not ready:
+				continue
+			if elem.tag == 'animated':
+				slot = len(constants)
+				slots[k] = slot
+				constants.append((0.0, 0.0))
+				levels.append(0)
+				animated.append((slot, elem))
+				continue
+			value = constantvalue(elem)
+			if value is not None:
+				slots[k] = len(constants)
+				constants.append(value)
+				levels.append(0)
+				continue
+			if elem.tag not in operations or (elem.tag == 'composite' and
+					elem.get('type') != 'vector'):
+				print("compilegraph: Cannot evaluate <%s type=\"%s\"> node" %
+						(elem.tag, elem.get('type')))
+				raise SystemExit
+			links = [linkvalue(elem, link, ids) for link in operations[elem.tag][0]]
+			if not ready:
+				stack.append((elem, True))
+				stack.extend((l, False) for l in links if key(l) not in slots)
+				continue
+			inputs = [slots[key(l)] for l in links]
+			slots[k] = len(constants)
+			constants.append((0.0, 0.0))
+			levels.append(1 + max(levels[i] for i in inputs))
+			nodes.append((slots[k], elem.tag, inputs))
+
+	for elem in outputs:
+		compilenode(elem)
+	for name, elem in ids.items():
+		if key(elem) in slots:
+			names[name] = slots[key(elem)]
+
+	# One step per depth and node type, in dependency order
+	groups = {}
+	for slot, tag, inputs in nodes:
+		groups.setdefault((levels[slot], tag), []).append((slot, inputs))
+	steps = []
+	for level, tag in sorted(groups):
+		group = groups[(level, tag)]
+		steps.append((operations[tag][1], np.array([s for s, i in group]),
+				[np.array(i) for i in zip(*[i for s, i in group])]))
+
+	program = Program()
+	program.size = len(constants)
+	program.constants = np.array(constants, dtype=float)
+	program.fps = float(root.get('fps', '24'))
+	program.animated = [(slot, readwaypoints(elem, ids, program.fps))
+			for slot, elem in animated]
+	program.steps = steps
+	program.outputs = np.array([slots[key(e)] for e in outputs], dtype=int)
+	program.names = names
+	return program
+
+def readwaypoints(elem, ids, fps):
+	"Waypoints of an animated node as (times, values, befores, afters)"
+	waypoints = elem.findall('waypoint')
+	values = [constantvalue(usevalue(w, ids)) for w in waypoints]
+	if not waypoints or None in values:
+		print("compilegraph: Only constant waypoints can be evaluated")
+		raise SystemExit
+	return ([parsetime(w.get('time'), fps) for w in waypoints], values,
+			[w.get('before', 'clamped') for w in waypoints],
+			[w.get('after', 'clamped') for w in waypoints])
+
+def run(program, times=None, inputs=None):
+	"""Evaluate a program, returning (outputs, batch, 2) values
+
+	times are seconds, one batch item each; they are required when the
+	graph has animated nodes. inputs maps exported ids or slots to values
+	(2,) or (batch, 2) that replace the ones in the file; an id the program
+	doesn't read raises ValueError.
+	"""
+	batch = 1
+	if times is not None:
+		times = np.atleast_1d(np.asarray(times, dtype=float))
+		batch = len(times)
+	for k in inputs or {}:
+		if k not in program.names and not (isinstance(k, int) and
+				0 <= k < program.size):
+			raise ValueError("run: Unknown input '%s'" % k)
+	inputs = dict((program.names.get(k, k), np.asarray(v, dtype=float))
+			for k, v in (inputs or {}).items())
+	for value in inputs.values():
+		if value.ndim == 2:
+			batch = max(batch, len(value))
+
+	regs = np.empty((program.size, batch, 2))
+	regs[:] = program.constants[:, None, :]
+	if program.animated:
+		if times is None:
+			print("run: The graph is animated, times are needed")
+			raise SystemExit
+		for slot, (keys, values, befores, afters) in program.animated:
+			regs[slot] = bake.interpolate(keys, values, befores, afters, times)
+	for slot, value in inputs.items():
+		regs[slot] = value
+	for operation, out, args in program.steps:
+		regs[out] = operation(*[regs[a] for a in args])
+	return regs[program.outputs]
+
+def deformedoutputs(root, ids=None):
+	"The point, t1 and t2 value nodes of each Deformed layer bline entry"
+	if ids is None:
+		ids = canvasdefs(root)
+	layers = []
+	for layer in root.findall('layer'):
+		if layer.get('desc') != 'Deformed':
+			continue
+		param = layer.find("param[@name='bline']")
+		bline = usevalue(param, ids)
+		entries = [usevalue(entry, ids) for entry in bline.findall('entry')]
+		layers.append([linkvalue(c, link, ids)
+				for c in entries for link in ('point', 't1', 't2')])
+	return layers
+
+if __name__ == "__main__":
+	import argparse
+	import gzip
+
+	parser = argparse.ArgumentParser(
+			description="Print the deformed vertices of a processed SIF file")
+	parser.add_argument('file')
+	parser.add_argument('--time', default='0f',
+			help="SIF time to evaluate animated values at (default 0f)")
+	args = parser.parse_args()
+
+	with open(args.file, 'rb') as f:
+		compressed = f.read(2) == b'\x1f\x8b'
+	f = gzip.open(args.file) if compressed else open(args.file, 'rb')
+	root = xmlbackend.parse(f).getroot()
+	f.close()
+
+	for n, outputs in enumerate(deformedoutputs(root)):
+		start = time.time()
+		program = compilegraph(root, outputs)
+		compiled = time.time()
+		values = run(program, [parsetime(args.time, program.fps)])[:, 0]
+		done = time.time()
+		sys.stderr.write("Deformed layer %d: %d nodes in %d steps, compiled in "
+				"%.1f ms, evaluated in %.2f ms\n" % (n, program.size,
+				len(program.steps), (compiled - start) * 1000, (done - compiled) * 1000))
+		for point, t1, t2 in values.reshape(-1, 3, 2):
+			print("%.6f %.6f %.6f %.6f %.6f %.6f" % (tuple(point) + tuple(t1) + tuple(t2)))
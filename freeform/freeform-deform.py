@@ -10,13 +10,152 @@
 
 from __future__ import unicode_literals
 
+import io
+import os
 import sys
-import xml.etree.ElementTree as ET
+import stat
+import glob
+import gzip
+import time
+import contextlib
+import fnmatch
+import argparse
+import re
+import copy
+import math
+import json
 import random
+import bisect
+import hashlib
+import tempfile
 import pprint
 import traceback
 
 from nodedict import *
+from graph import *
+from xmlbackend import ET
+import xmlbackend
+from evaluator import canvasdefs, linkvalue, usevalue, parsetime
+import evaluator
+import bake
+import cache
+import deformclient
+
+# Output modes understood by process():
+#   inline - every exported value is copied into each place it is used
+#   shared - exported values stay in <defs> and are referenced by id
+#   dedup  - identical nodes are merged, values used once are inlined and
+#            the rest stay in <defs>
+#   bake   - the rig of an already processed file is evaluated and the
+#            deformed layers get plain vectors
+#   bake-animated - as bake, sampled over the canvas time range into
+#            keyed vectors
+outputmodes = ('inline', 'shared', 'dedup', 'bake', 'bake-animated')
+
+# Exported ids of the per-point nodes and shared constants: short base-36
+# ids by default, or names like point12_window when readable is set
+readable = False
+
+# Name of the canvas meta data recording the rig, see writerig()
+rigmeta = 'freeform_deform_rig'
+
+# Salt of the GUIDs of the rig, and the ids the file exports already
+rigsalt = ''
+reserved = set()
+
+# Form of the rig fragments kept in the cache, see cachefragment()
+cacheversion = 1
+
+# Elements standing for XML text taken from the cache, written as it is
+verbatim = {}
+
+# Exported names of the source points of the rigged layers
+pointname = re.compile(r'(?:layer(\d+)_)?point\d+$')
+
+# Degree of the segments of each control type. The control path has one
+# or more segments, a single quadratic one is the original control curve.
+controltypes = {'quadratic': 2, 'cubic': 3}
+
+# Types of layers with a bline that can be deformed
+deformabletypes = ('outline', 'region', 'advanced_outline')
+
+# Descriptions of the layers added by process()
+generateddescs = ('Window', 'ControlBezier', 'Deformed')
+
+# Tags of plain (non convert) value nodes
+valuetypes = ('real', 'vector', 'angle', 'bool', 'integer', 'color', 'time',
+		'string', 'gradient')
+
+# Functions whose calls are counted when profiling
+profiledcalls = ('xmldup_r', 'exportnode', 'connectnode', 'linkuse', 'lowernode',
+		'nodeparts', 'writeelem')
+
+# Phases, call counts and memory recorded by startprofile(), None when off
+profile = None
+
+def countcalls(name, function):
+	"Wrap function to count its calls in the profile"
+	def counted(*args, **kwargs):
+		profile['calls'][name] += 1
+		return function(*args, **kwargs)
+	counted.original = function
+	return counted
+
+def startprofile():
+	"Start recording phase times, allocated memory and call counts"
+	global profile
+	import tracemalloc
+	tracemalloc.start()
+	profile = {'phases': {}, 'calls': {}, 'running': None, 'start': time.time(),
+			'peak': 0}
+	for name in profiledcalls:
+		profile['calls'][name] = 0
+		globals()[name] = countcalls(name, globals()[name])
+
+def phase(name):
+	"End the running profile phase and start the named one, when profiling"
+	global profile
+	if profile is None:
+		return
+	import tracemalloc
+	now = time.time()
+	current, peak = tracemalloc.get_traced_memory()
+	# The peak is reset for every phase, the run's peak is their maximum
+	profile['peak'] = max(profile['peak'], peak)
+	if profile['running'] is not None:
+		running, start, allocated = profile['running']
+		if running not in profile['phases']:
+			profile['phases'][running] = {'seconds': 0.0, 'allocated': 0,
+					'peak': 0, 'runs': 0}
+		record = profile['phases'][running]
+		record['seconds'] += now - start
+		record['allocated'] += current - allocated
+		record['peak'] = max(record['peak'], peak - allocated)
+		record['runs'] += 1
+	profile['running'] = None
+	if name is not None:
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+		profile['running'] = (name, time.time(), current)
+
+def stopprofile(path, info):
+	"Stop profiling and write the report as JSON to path"
+	global profile
+	import tracemalloc
+	phase(None)
+	report = dict(info)
+	report['seconds'] = time.time() - profile['start']
+	report['peak'] = profile['peak']
+	report['phases'] = [dict(name=name, **record)
+			for name, record in profile['phases'].items()]
+	report['calls'] = profile['calls']
+	tracemalloc.stop()
+	for name in profiledcalls:
+		globals()[name] = globals()[name].original
+	profile = None
+	with open(path, 'w') as f:
+		json.dump(report, f, indent=2)
+		f.write('\n')
 
 def et_iter(tree, tag=None):
 	if sys.hexversion >= 0x02070000:
@@ -24,172 +163,673 @@ def et_iter(tree, tag=None):
 	else:
 		return iter(tree.getiterator(tag))
 
-def adddef_usage(parent, name):
-	global defs_usage
-	if parent in defs_usage:
-		defs_usage[parent].append(name)
-	else:
-		defs_usage[parent] = [name]
-
 def xmldup_r(src):
-	"Duplicate given node, respecting already exported defs"
-	global defs
-	global defs_usage
+	"Duplicate given node"
+	if xmlbackend.lxml:
+		# Copied in C, then without the tails as below
+		dst = copy.deepcopy(src)
+		dst.tail = None
+		for elem in dst.iterdescendants():
+			elem.tail = None
+		return dst
 	dst = ET.Element(src.tag, src.attrib)
 	dst.text = src.text
-	if src in defs_usage:
-		for def_name in defs_usage[src]:
-			adddef_usage(dst, def_name)
-			def_attr = defs[def_name][1][src]
-			defs[def_name][1][dst] = def_attr
 	for elem in src:
 		dst.append(xmldup_r(elem))
 	return dst
 
 def getblinepoints(layer):
-	"Find the vertex nodes of bline parameter on given layer"
-	#return layer.findall('param[@name="bline"]/bline/entry/composite/point')
+	"Find the bline_point composites with a vertex node on given layer"
+	#return layer.findall('param[@name="bline"]/bline/entry/composite')
 	params = layer.findall('param')
 	for p in params:
 		if 'name' in p.attrib and p.attrib['name'] == 'bline':
-			return p.findall('use/bline/entry/composite/point')
-
-def addguid(elem):
-	"Add a GUID attribute to given element"
-	elem.set('guid', "%032X" % random.getrandbits(128))
-
-def parentnode(elem, root):
-	"Finds parent node of specified element"
-	for p in et_iter(root):
-		for c in p:
-			if c == elem:
-				return p
-
-def cleanemptyelem(elem):
-	"Clean whitespace from element if it has no childs"
-	count = 0
-	for c in elem:
-		count += 1
-	if count == 0:
-		elem.text = elem.text.strip()
-
-def exportnew(elem, name):
-	"Create new exported node from given element with given name"
-	global defs
-	global defs_keys
-	newelem = xmldup_r(elem)
-	defs[name] = (newelem, {})
-	defs_keys.append(name)
-	return newelem
-
-def exportnode(elem, root, name):
-	"Export specified node element to defs with given name"
-	global defs
-	global defs_keys
-	global defs_usage
-	if name in defs:
-		print("exportnode: There's an exported node with name '%s' already" % name)
-		raise SystemExit
-	parent = parentnode(elem, root)
-	parent.remove(elem)
-	parent.set(elem.tag, name)
-	cleanemptyelem(parent)
-	defs[name] = (elem[0], { parent: elem.tag })
-	defs_keys.append(name)
-	adddef_usage(parent, name)
+			return [c for c in p.findall('bline/entry/composite')
+					if c.find('point') is not None]
+	return []
+
+def segmentdistance(p, a, b):
+	"Distance of point p from the line segment a-b"
+	dx = b[0] - a[0]
+	dy = b[1] - a[1]
+	length2 = dx * dx + dy * dy
+	t = 0.0
+	if length2:
+		t = min(1.0, max(0.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length2))
+	return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+def simplifypoints(composites, tolerance, loop):
+	"""Pick the bline_point composites worth rigging, as a sorted index list
+
+	Ramer-Douglas-Peucker on the vertices: a point is dropped when it lies
+	within tolerance of the line between the points kept around it. The
+	rig fits its curves through the vertices only, so the deformed outline
+	of the kept points follows the dropped ones as closely. Animated
+	vertices and the ends of an open bline are always kept.
+	"""
+	values = [initialvalue(c.find('point')[0]) for c in composites]
+	n = len(values)
+	if n < 3:
+		return list(range(n))
+	anchors = [i for i, c in enumerate(composites)
+			if evaluator.constantvalue(c.find('point')[0]) is None]
+	if not loop:
+		anchors = sorted(set(anchors) | set((0, n - 1)))
+	elif len(anchors) < 2:
+		# Split a closed bline at the vertex farthest from the first
+		# readable anchor, or the first readable vertex without one
+		known = [i for i, v in enumerate(values) if v is not None]
+		if not known:
+			return list(range(n))
+		first = ([i for i in anchors if values[i] is not None] + known)[0]
+		far = max((math.hypot(v[0] - values[first][0], v[1] - values[first][1]), i)
+				for i, v in enumerate(values) if v is not None)
+		anchors = sorted(set(anchors) | set((first, far[1])))
+
+	keep = set(anchors)
+	runs = list(zip(anchors, anchors[1:]))
+	if loop:
+		runs.append((anchors[-1], anchors[0] + n))
+	for run in runs:
+		stack = [run]
+		while stack:
+			a, b = stack.pop()
+			if b - a < 2:
+				continue
+			inner = [values[i % n] for i in range(a + 1, b)]
+			if None in inner or values[a % n] is None or values[b % n] is None:
+				# Vertices that can't be read are kept with their neighbours
+				keep.update(i % n for i in range(a + 1, b))
+				continue
+			distance, k = max((segmentdistance(p, values[a % n], values[b % n]), i)
+					for i, p in enumerate(inner, a + 1))
+			if distance > tolerance:
+				keep.add(k % n)
+				stack += [(a, k), (k, b)]
+	return sorted(keep)
+
+def linkuse(elem, attrib, node):
+	"Link graph node from attribute of a layer element"
+	global uses
+	if elem in uses:
+		uses[elem].append((attrib, node))
+	else:
+		uses[elem] = [(attrib, node)]
+
+def linkbuilt(node):
+	"Link the graph nodes referenced by an element built by a nodedict builder"
+	elem, refs = node
+	for ref in refs:
+		linkuse(*ref)
 	return elem
 
-def connectnode(elem, root, name):
-	"Connect exported node with specified name at location of given element"
-	global defs
-	global defs_usage
-	if name not in defs:
-		print("connectnode: Cannot find exported node with name '%s'" % name)
+def exportnode(elem, attrib, label):
+	"Move value node held by attribute child of elem into the graph"
+	global graph
+	child = elem.find(attrib)
+	elem.remove(child)
+	node = graph.element(child[0], label)
+	linkuse(elem, attrib, node)
+	return node
+
+def connectnode(elem, attrib, node):
+	"Replace the value held by attribute child of elem with a graph node"
+	# A param holds its value directly, linked through its use attribute
+	for child in elem.findall('*' if elem.tag == 'param' else attrib):
+		elem.remove(child)
+	linkuse(elem, attrib, node)
+
+def exportrig(rig, name, build, *args):
+	"Add rig node with given name, linking the rig nodes named in args"
+	rig[name] = build(*[rig[a] if isinstance(a, str) else a for a in args],
+			label=name)
+
+def exportleg(rig, name, start, end):
+	"Add the rig nodes of the unit frame i, j of the leg from start to end"
+	span = '%s_minus_%s' % (end, start)
+	exportrig(rig, span, graph.substract_vector, end, start)
+	exportrig(rig, span + '_length', graph.vectorlength, span)
+	exportrig(rig, span + '_length_reciprocal', graph.reciprocal, span + '_length')
+	exportrig(rig, name + '_i', graph.scale_vector, span, span + '_length_reciprocal')
+	exportrig(rig, name + '_i_vectorx', graph.vectorx, name + '_i')
+	exportrig(rig, name + '_i_vectory', graph.vectory, name + '_i')
+	exportrig(rig, 'minus_' + name + '_i_vectory', graph.substract_real,
+			0.0, name + '_i_vectory')
+	exportrig(rig, name + '_j', graph.composite,
+			'minus_' + name + '_i_vectory', name + '_i_vectorx')
+
+def bezierlength(p0, p1, p2, p3, samples=32):
+	"Arc length of a cubic Bezier curve, summed over chords"
+	t = bake.np.linspace(0.0, 1.0, samples + 1)[:, None]
+	points = ((1 - t) ** 3 * p0 + 3 * (1 - t) ** 2 * t * p1
+			+ 3 * (1 - t) * t ** 2 * p2 + t ** 3 * p3)
+	return bake.np.hypot(*bake.np.diff(points, axis=0).T).sum()
+
+def ishandle(offset):
+	"Whether a control point offset from its vertex makes a leg the rig can frame"
+	return bake.np.hypot(*offset) > 0.000001
+
+def exportpath(rig, root, layer):
+	"""Export the vertices and tangents of a spline layer as the control path
+
+	The layer keeps using the exported values, so editing it moves the rig.
+	Returns the names of the control vertices and the spans of the cubic
+	segments, see pathcurves(), sized by their arc length. The handles of
+	vertices that have no tangent when rigged follow the chord instead.
+	"""
+	global graph
+	composites = getblinepoints(layer)
+	bline = findparam(layer, 'bline').find('bline')
+	if len(composites) < 2 or len(composites) != len(bline.findall('entry')):
+		print("exportpath: The path layer needs two or more vertices held in "
+				"its bline")
+		raise SystemExit
+
+	# Values the arc length table is computed from, at the start of the canvas
+	vertices = []
+	tangents1 = []
+	tangents2 = []
+	split = []
+	for c in composites:
+		# Unsplit tangents use t1 on both sides
+		flags = [c.find(name) for name in ('split', 'split_radius', 'split_angle')]
+		flags = [f[0] for f in flags if f is not None and len(f)]
+		split.append(not flags or any(f.tag != 'bool' or f.get('value') == 'true'
+				for f in flags))
+	for k, c in enumerate(composites):
+		vertices.append(exportnode(c, 'point', ('path_point%d', k)))
+		tangents1.append(exportnode(c, 't1', ('path_t1_%d', k)))
+		if split[k]:
+			tangents2.append(exportnode(c, 't2', ('path_t2_%d', k)))
+		else:
+			tangents2.append(tangents1[k])
+	nodes = [graph.nodes[i].links for i in vertices + tangents1 + tangents2]
+	program = evaluator.compilegraph(root, nodes)
+	values = evaluator.run(program, [0.0])[:, 0].reshape(3, -1, 2)
+
+	ends = list(ntuples(list(range(len(composites))), 2))
+	if bline.get('loop') != 'true':
+		ends = ends[:-1]
+	controls = []
+	lengths = []
+	vertex, tangent = values[0], values[1:]
+	for k, (a, b) in enumerate(ends):
+		m = 3 * k
+		rig['P%d' % m] = vertices[a]
+		# A vertex without a tangent, like a clicked corner, would make a
+		# leg of no length: its handle goes a third of the way along the
+		# chord instead, which keeps the segment on the same straight line
+		handle1 = tangent[1][a] / 3
+		handle2 = tangent[0][b] / 3
+		chord = None
+		if not ishandle(handle1) or not ishandle(handle2):
+			chord = graph.substract_vector(vertices[b], vertices[a], 1.0 / 3,
+					label=('path_chord%d', k))
+		if ishandle(handle1):
+			handle = graph.scale_vector(tangents2[a], 1.0 / 3, label=('path_handle%d', m + 1))
+		else:
+			handle = chord
+			handle1 = (vertex[b] - vertex[a]) / 3
+		rig['P%d' % (m + 1)] = graph.add_vector(vertices[a], handle, label='P%d' % (m + 1))
+		if ishandle(handle2):
+			handle = graph.scale_vector(tangents1[b], 1.0 / 3, label=('path_handle%d', m + 2))
+		else:
+			handle = chord
+			handle2 = (vertex[b] - vertex[a]) / 3
+		rig['P%d' % (m + 2)] = graph.substract_vector(vertices[b], handle,
+				label='P%d' % (m + 2))
+		controls += ['P%d' % i for i in range(m, m + 3)]
+		lengths.append(bezierlength(vertex[a], vertex[a] + handle1,
+				vertex[b] - handle2, vertex[b]))
+	rig['P%d' % (3 * len(ends))] = vertices[ends[-1][1]]
+	controls.append('P%d' % (3 * len(ends)))
+
+	total = sum(lengths)
+	if not total:
+		print("exportpath: The path layer has no length")
 		raise SystemExit
-	parent = parentnode(elem, root)
-	parent.remove(elem)
-	parent.set(elem.tag, name)
-	cleanemptyelem(parent)
-	defs[name][1][parent] = elem.tag
-	adddef_usage(parent, name)
-
-def unexportnode(name):
-	"Unexport def with specified name"
-	global defs
-	global defs_keys
-	global defs_usage
-	elem = defs[name][0]
-	addguid(elem)
-	uses = defs[name][1]
-	for use in uses.items():
-		parent = use[0]
-		attrib = use[1]
-		defs_usage[parent].remove(name)
-		del parent.attrib[attrib]
-		ET.SubElement(parent, attrib).append(xmldup_r(elem))
-	del defs[name]
-	if name in defs_keys:
-		defs_keys.remove(name)
-
-def gendef(name, root):
-	"Generate XML for def with specified name"
-	global defs
+	spans = []
+	start = 0.0
+	for length in lengths:
+		spans.append((start / total, total / length if length else 0.0))
+		start += length
+	return controls, spans
+
+def pickshared(mode):
+	"Pick the graph nodes written once to the defs, the rest are inlined"
+	global graph
+	global uses
+	global shared
+	# Values exported in the file already are always linked by id
+	shared = dict((i, node.links) for i, node in enumerate(graph.nodes)
+			if node.tag == 'extern')
+	if mode == 'inline':
+		return
+	remap = list(range(len(graph)))
+	if mode == 'dedup':
+		remap = mergeduplicates(graph)
+		for links in uses.values():
+			links[:] = [(attrib, remap[node]) for attrib, node in links]
+	roots = [node for links in uses.values() for attrib, node in links]
+	# Exported values are written even when nothing links to them
+	kept = [i for i, node in enumerate(graph.nodes)
+			if node.label is not None and remap[i] == i]
+	counts = usecounts(graph, roots + kept)
+	for i in kept:
+		counts[i] -= 1
+
+	def nextname(numbered):
+		"Next short id, or constN name, not exported in the file yet"
+		while True:
+			name = 'const%d' % serial[0] if numbered else '_' + base36(serial[0])
+			serial[0] += 1
+			if name not in reserved:
+				return name
+
+	names = set(reserved)
+	serial = [0]
+	for i, node in enumerate(graph.nodes):
+		if remap[i] != i or node.tag == 'extern':
+			continue
+		elif node.label is not None:
+			if mode == 'dedup' and counts[i] == 1:
+				continue
+			# Values taken from the source file keep readable names
+			if isinstance(node.label, tuple) and not readable and node.tag is not None:
+				name = nextname(False)
+			else:
+				name = labelname(node.label)
+			if name in names:
+				print("pickshared: There's an exported node with name '%s' already" % name)
+				raise SystemExit
+			names.add(name)
+			shared[i] = name
+		elif mode == 'dedup' and node.tag in valuetypes and counts[i] > 1:
+			# Constants linked from several convert nodes
+			shared[i] = nextname(readable)
+
+def lowernode(i):
+	"Build the element of graph node i, inlining the nodes not shared"
+	global graph
+	global shared
+	global lowered
+	# lxml copies a subtree in C faster than it builds it again
+	if i in lowered:
+		return copy.deepcopy(lowered[i])
+	node = graph.nodes[i]
+	if node.tag is None:
+		elem = xmldup_r(node.links)
+	elif node.tag in valuetypes:
+		elem = constant(node.tag, node.links)
+	else:
+		elem = ET.Element(node.tag, {'type': node.type})
+		for link, j in node.links:
+			if j in shared:
+				elem.set(link, shared[j])
+			else:
+				ET.SubElement(elem, link).append(lowernode(j))
+	if node.label is not None and i not in shared:
+		elem.set('guid', nodeguid(i))
+	if xmlbackend.lxml and i not in shared:
+		lowered[i] = elem
+	return elem
+
+def nodeguid(i):
+	"GUID linking the copies of inlined graph node i, the same in every run"
+	global guids
+	if i not in guids:
+		guids[i] = nameguid(labelname(graph.nodes[i].label))
+	return guids[i]
+
+def nameguid(name):
+	"GUID of the node exported under name in this rig"
+	return hashlib.md5((rigsalt + name).encode('utf-8')).hexdigest().upper()
+
+def lowertree(root):
+	"Put the graph nodes into the tree, in the defs or at each use"
+	global uses
+	global shared
+	for elem, links in uses.items():
+		for attrib, node in links:
+			if node in shared:
+				elem.set(attrib, shared[node])
+			elif elem.tag == 'param':
+				elem.append(lowernode(node))
+			else:
+				ET.SubElement(elem, attrib).append(lowernode(node))
+	for i in sorted(shared):
+		gendef(i, root)
+
+def gendef(i, root):
+	"Generate XML for shared graph node i"
+	global shared
+	if graph.nodes[i].tag == 'extern':
+		return
+	# Append element to defs section
+	elem = lowernode(i)
+	elem.set('id', shared[i])
+	defssection(root).append(elem)
+
+def defssection(root):
+	"Find the defs section of the canvas, adding it if it doesn't exist"
 	defs_section = root.find('defs')
-	# Add defs section if it doesn't exist
+	# Add defs section ahead of the layers using it
 	if defs_section == None:
 		defs_section = ET.Element(u'defs')
-		root.insert(0, defs_section)
-	# Append element to defs section
-	elem = defs[name][0]
-	elem.set('id', name)
-	defs_section.append(elem)
-
-def paramwrap(root):
-	"Wrap child element of param elements within a <use> element"
-	params = root.findall('layer/param')
-	for p in params:
-		# Count number of childs
-		count = 0
-		for c in p:
-			count += 1
-		if count > 1:
-			# param should never have more than one child
-			print("paramwrap: param element with more than one child")
-			raise SystemExit
-		elif count == 1:
-			# wrap single child inside a <use> element
-			for c in p:
-				child = c
-			p.remove(child)
-			use = ET.SubElement(p, u'use')
-			use.append(child)
-		elif count == 0:
-			# No child elements so do nothing
-			pass
-
-def paramunwrap(root):
-	"Unwrap child element of param elements within a <use> element"
-	params = root.findall('layer/param')
-	for p in params:
-		# Count number of childs
-		count = 0
-		for c in p:
-			count += 1
-		if count > 1:
-			# param should never have more than one child
-			print("paramwrap: param element with more than one child")
-			raise SystemExit
-		elif count == 1:
-			# unwrap single child inside a <use> element
-			for c in p:
-				use = c
-			for c in use:
-				child = c
-			p.remove(use)
-			p.append(child)
-		elif count == 0:
-			# No child elements so do nothing
-			pass
+		layers = root.findall('layer')
+		if layers:
+			root.insert(list(root).index(layers[0]), defs_section)
+		else:
+			root.insert(0, defs_section)
+	return defs_section
+
+def elemsize(elem):
+	"Size of element as written, not counting graph nodes"
+	size = len(elem.tag) + 1 + len(escapetext(elem.tail or ''))
+	for k, v in elem.attrib.items():
+		size += len(k) + len(escapeattrib(v)) + 4
+	if len(elem) or elem.text:
+		size += len(elem.tag) + 4 + len(escapetext(elem.text or ''))
+		for child in elem:
+			size += elemsize(child)
+	else:
+		size += 3
+	return size
+
+def predictsize(root):
+	"Predict the value node count and byte size of the processed file"
+	global graph
+	global uses
+	global shared
+	counts = [0] * len(graph)
+	sizes = [0] * len(graph)
+	# Nodes only link earlier ones, so one forward pass sizes every copy
+	for i, node in enumerate(graph.nodes):
+		counts[i] = 1
+		if node.tag == 'extern':
+			continue
+		elif node.tag in linktypes:
+			counts[i] += sum(counts[j] for link, j in node.links if j not in shared)
+		for part in inlineparts(i):
+			sizes[i] += len(part) if isinstance(part, str) else sizes[part]
+
+	nodes = 0
+	size = len('<?xml version="1.0" encoding="UTF-8"?>\n') + elemsize(root)
+	for elem, links in uses.items():
+		for attrib, i in links:
+			if i in shared:
+				size += len(attrib) + len(shared[i]) + 4
+			else:
+				nodes += counts[i]
+				size += sizes[i]
+				if elem.tag != 'param':
+					size += len(attrib) * 2 + 5
+	for i, name in shared.items():
+		if graph.nodes[i].tag == 'extern':
+			continue
+		nodes += counts[i]
+		size += sizes[i] + len(name) + 6
+	if shared and root.find('defs') is None:
+		size += len('<defs></defs>')
+	return nodes, size
+
+def formatsize(size):
+	"Format a byte count for messages"
+	for unit in ('bytes', 'kB', 'MB'):
+		if size < 1024:
+			return '%d %s' % (size, unit) if unit == 'bytes' else '%.1f %s' % (size, unit)
+		size /= 1024.0
+	return '%.1f GB' % size
+
+def checkbudget(root, mode, budget, overbudget):
+	"Compare the predicted output size with the budget, maybe picking a cheaper mode"
+	global texts
+	nodes, size = predictsize(root)
+	if size <= budget:
+		return mode
+	print("checkbudget: %s output would be about %s (%d value nodes), over the "
+			"budget of %s" % (mode, formatsize(size), nodes, formatsize(budget)))
+	if overbudget == 'abort':
+		raise SystemExit
+	elif overbudget == 'warn':
+		return mode
+
+	# Fall back to the first mode that fits, or to the smallest one
+	best = (size, mode)
+	for cheaper in ('dedup', 'shared'):
+		if cheaper == mode:
+			continue
+		texts = {}
+		pickshared(cheaper)
+		nodes, size = predictsize(root)
+		if size <= budget:
+			best = (size, cheaper)
+			break
+		best = min(best, (size, cheaper))
+	size, cheaper = best
+	if cheaper != mode:
+		texts = {}
+		pickshared(cheaper)
+	print("checkbudget: Writing %s output instead, about %s" % (cheaper, formatsize(size)))
+	return cheaper
+
+def escapetext(text):
+	"Escape character data for XML output"
+	if '&' in text:
+		text = text.replace('&', '&amp;')
+	if '<' in text:
+		text = text.replace('<', '&lt;')
+	if '>' in text:
+		text = text.replace('>', '&gt;')
+	return text
+
+def escapeattrib(text):
+	"Escape attribute value for XML output"
+	text = escapetext(text)
+	if '"' in text:
+		text = text.replace('"', '&quot;')
+	if '\n' in text:
+		text = text.replace('\n', '&#10;')
+	return text
+
+def writestart(out, tag, attrib, empty):
+	"Write start tag with given attributes"
+	out.write('<' + tag)
+	for k, v in attrib:
+		out.write(' %s="%s"' % (k, escapeattrib(v)))
+	out.write(' />' if empty else '>')
+
+def nodeparts(i, name=None):
+	"Split the XML of graph node i into strings and ids of nodes to inline"
+	global graph
+	global shared
+	node = graph.nodes[i]
+	text = io.StringIO()
+	if node.tag not in linktypes:
+		# Constants and source elements link nothing, write them as a whole
+		elem = lowernode(i)
+		if name is not None:
+			elem.set('id', name)
+		writeelem(text, elem, False, True)
+		return [text.getvalue()]
+	attrib = [('type', node.type)]
+	attrib += [(link, shared[j]) for link, j in node.links if j in shared]
+	if node.label is not None and i not in shared:
+		attrib.append(('guid', nodeguid(i)))
+	if name is not None:
+		attrib.append(('id', name))
+	inline = [(link, j) for link, j in node.links if j not in shared]
+	writestart(text, node.tag, attrib, not inline)
+	parts = []
+	for link, j in inline:
+		text.write('<%s>' % link)
+		if graph.nodes[j].tag not in linktypes:
+			text.write(inlineparts(j)[0])
+		else:
+			# Kept apart, whole expansions would take as much memory as the file
+			parts.append(text.getvalue())
+			parts.append(j)
+			text = io.StringIO()
+		text.write('</%s>' % link)
+	if inline:
+		text.write('</%s>' % node.tag)
+	parts.append(text.getvalue())
+	return parts
+
+def inlineparts(i):
+	"Pieces of the XML of graph node i as inlined, see nodeparts()"
+	global texts
+	if i not in texts:
+		texts[i] = nodeparts(i)
+	return texts[i]
+
+def writenode(out, i):
+	"Write graph node i as inlined at one of its uses"
+	for part in inlineparts(i):
+		if isinstance(part, str):
+			out.write(part)
+		else:
+			writenode(out, part)
+
+def writeelem(out, elem, tail=True, copy=False):
+	"Write element, with the graph nodes linked from it"
+	# Copies are written the way xmldup_r() makes them, without tails
+	global uses
+	global shared
+	if elem in verbatim:
+		out.write(verbatim[elem])
+		if tail and elem.tail:
+			out.write(escapetext(elem.tail))
+		return
+	links = []
+	attrib = elem.attrib
+	if elem in uses:
+		attrib = dict(attrib)
+		for link, node in uses[elem]:
+			if node in shared:
+				attrib[link] = shared[node]
+			else:
+				links.append((link, node))
+	children = [(c, True) for c in elem]
+	if elem.tag == 'param':
+		for link in links:
+			if link[0] == 'use':
+				links.remove(link)
+				children.append((link[1], None))
+				break
+	empty = not children and not links and not elem.text
+	writestart(out, elem.tag, attrib.items(), empty)
+	if not empty:
+		if elem.text:
+			out.write(escapetext(elem.text))
+		for child, child_tail in children:
+			if child_tail is None:
+				writenode(out, child)
+			else:
+				writeelem(out, child, child_tail and not copy, copy)
+		for link in links:
+			out.write('<%s>' % link[0])
+			writenode(out, link[1])
+			out.write('</%s>' % link[0])
+		out.write('</%s>' % elem.tag)
+	if tail and elem.tail:
+		out.write(escapetext(elem.tail))
+
+def writedefs(out, defs_section):
+	"Write defs section, followed by the shared graph nodes"
+	global shared
+	if defs_section is not None:
+		writestart(out, 'defs', defs_section.attrib.items(), False)
+		if defs_section.text:
+			out.write(escapetext(defs_section.text))
+		for child in defs_section:
+			writeelem(out, child)
+	else:
+		out.write('<defs>')
+	for i in sorted(shared):
+		writedef(out, i)
+	out.write('</defs>')
+	if defs_section is not None and defs_section.tail:
+		out.write(escapetext(defs_section.tail))
+
+def writedef(out, i):
+	"Write shared graph node i as it is exported in the defs"
+	if graph.nodes[i].tag == 'extern':
+		return
+	for part in nodeparts(i, shared[i]):
+		if isinstance(part, str):
+			out.write(part)
+		else:
+			writenode(out, part)
+
+def writesif(tree, f):
+	"Write tree processed with stream=True to binary file object"
+	global shared
+	out = io.TextIOWrapper(f, encoding='utf-8', newline='\n')
+	out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+	root = tree.getroot()
+	writestart(out, root.tag, root.attrib.items(), False)
+	if root.text:
+		out.write(escapetext(root.text))
+	defs_written = root.find('defs') is None and not shared
+	for child in list(root):
+		if child.tag == 'defs':
+			writedefs(out, child)
+			defs_written = True
+		else:
+			if child.tag == 'layer' and not defs_written:
+				writedefs(out, None)
+				defs_written = True
+			writeelem(out, child)
+		# Serialized, so the canvas doesn't need to keep it any longer
+		root.remove(child)
+	out.write('</%s>' % root.tag)
+	out.flush()
+	out.detach()
+
+def isgzip(path):
+	"Check whether given file is gzip compressed"
+	with open(path, 'rb') as f:
+		return f.read(2) == b'\x1f\x8b'
+
+def opensif(path, mode='rb', compress=False, compresslevel=6):
+	"Open SIF file, (de)compressing .sifz data on the fly"
+	if 'r' in mode:
+		compress = isgzip(path)
+	if compress:
+		return gzip.open(path, mode, compresslevel=compresslevel)
+	return open(path, mode)
+
+@contextlib.contextmanager
+def replacingsif(path, compress=False, compresslevel=6):
+	"""Open a SIF file to write in place of the one at path
+
+	The data goes to a temporary file beside it, renamed over it once the
+	block ends without error, so a failed write leaves the file as it was.
+	"""
+	target = os.path.realpath(path)
+	name = os.path.basename(target)
+	try:
+		fd, temp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp',
+				dir=os.path.dirname(target))
+		raw = os.fdopen(fd, 'wb')
+	except (IOError, OSError):
+		print("Could not open output file:", path)
+		raise SystemExit
+	try:
+		with raw:
+			if compress:
+				# The gzip header names the file, not the temporary one
+				with gzip.GzipFile(name, 'wb', compresslevel, raw) as f:
+					yield f
+			else:
+				yield raw
+		if os.path.exists(target):
+			os.chmod(temp, stat.S_IMODE(os.stat(target).st_mode))
+		os.replace(temp, target)
+	except BaseException:
+		os.remove(temp)
+		raise
 
 def findparam(layer, name):
 	"Find param element with specified name inside layer"
@@ -204,470 +844,908 @@ def ntuples(lst, n):
 def ntuplesrotated(lst, n):
 	return zip(*map((lambda l: l[-1:]+l[:-1]), [lst[i:]+lst[:i] for i in range(n)]))
 
-def process(tree):
-	"Process XML on given tree object"
-	global defs
-	global defs_keys
-	global defs_usage
+def initialvalue(elem):
+	"Value of a source value node, at its first waypoint if animated, or None"
+	if elem.tag == 'animated':
+		waypoint = elem.find('waypoint')
+		if waypoint is None or len(waypoint) == 0:
+			return None
+		elem = waypoint[0]
+	return evaluator.constantvalue(elem)
+
+def pathpoint(x, y, rig, control, segment, label):
+	"""Place window coordinates x, y on one segment of the control path
+
+	The coordinates are put in the frame of each leg of the segment, as the
+	quadratic curve does with segment01 and segment12, and the offset points
+	are blended de Casteljau style down to the deformed point.
+	"""
+	global graph
+	degree, spans = control
+	pattern, index = label
+	start, scale = spans[segment]
+	u = graph.substract_real(x, start, scale, label=(pattern + '_u', index))
+	one_minus_u = graph.substract_real(1.0, u, label=(pattern + '_one_minus_u', index))
+
+	level = []
+	for m in range(segment * degree, (segment + 1) * degree):
+		leg = pattern + '_leg%d' % m
+		x_scale = graph.scale_real(u, rig['P%d_minus_P%d_length' % (m + 1, m)],
+				label=(leg + '_x_scale', index))
+		leg_i = graph.scale_vector(rig['leg%d_i' % m], x_scale,
+				label=(leg + '_i', index))
+		leg_j = graph.scale_vector(rig['leg%d_j' % m], y,
+				label=(leg + '_j', index))
+		i_plus_j = graph.add_vector(leg_i, leg_j, label=(leg + '_i_plus_j', index))
+		level.append(graph.add_vector(rig['P%d' % m], i_plus_j, label=(leg, index)))
+
+	depth = 1
+	while len(level) > 1:
+		blended = []
+		for k in range(len(level) - 1):
+			name = pattern if len(level) == 2 else pattern + '_blend%d_%d' % (depth, k)
+			lhs = graph.scale_vector(level[k], one_minus_u, label=(name + '_lhs', index))
+			rhs = graph.scale_vector(level[k + 1], u, label=(name + '_rhs', index))
+			blended.append(graph.add_vector(lhs, rhs, label=(name, index)))
+		level = blended
+		depth += 1
+	return level[0]
+
+def pathcurves(points, window_x, window_y, rig, control, prefix):
+	"""Curve startpoint, endpoint and midpoint nodes for a control path
+
+	control is (degree, spans): the path has segments of the given degree,
+	each covering the part of the window x range that starts at x = start
+	and has its segment parameter (x - start) * scale, for each (start,
+	scale) in spans. Every deformee point, and every curve midpoint, is
+	bound to the one segment covering its window x coordinate when the rig
+	is built, so the graph grows with the points only, not with the
+	segments. Points outside the window use the first or the last segment.
+	"""
+	global graph
+	degree, spans = control
+	n = range(len(points))
+	pointtuples = list(ntuples(list(n), 2))
+	bounds = [start for start, scale in spans[1:]]
+
+	# The window starts out spanning 0 to 1, so window x is the point's x
+	initial_x = []
+	for i in n:
+		value = initialvalue(graph.nodes[points[i]].links)
+		initial_x.append(value[0] if value is not None else 0.0)
+
+	curve = {}
+	curve['startpoint'] = [pathpoint(window_x[i], window_y[i], rig, control,
+			bisect.bisect_right(bounds, initial_x[i]),
+			(prefix + 'curve%d_startpoint', i)) for i in n]
+	curve['endpoint'] = [curve['startpoint'][b] for a, b in pointtuples]
+
+	curve['midpoint'] = []
+	for a, b in pointtuples:
+		t_mid = graph.add_real(window_x[a], window_x[b], 0.5,
+				label=(prefix + 'curve%d_t_mid', a))
+		y_mid = graph.add_real(window_y[a], window_y[b], 0.5,
+				label=(prefix + 'curve%d_y_mid', a))
+		segment = bisect.bisect_right(bounds, (initial_x[a] + initial_x[b]) * 0.5)
+		curve['midpoint'].append(pathpoint(t_mid, y_mid, rig, control, segment,
+				(prefix + 'curve%d_midpoint', a)))
+	return curve
+
+def deformlayer(layer, deformed, rig, prefix='', control=None, tolerance=None):
+	"""Build the point subgraph deforming layer and connect it to deformed
+
+	control is None for the quadratic control curve, or (degree, spans)
+	for a control path, see pathcurves(). With a tolerance, only the points
+	picked by simplifypoints() are rigged.
+	"""
+	global graph
+
+	# Deformee exports
+	phase('point exports')
+	composites = getblinepoints(layer)
+	if tolerance is not None:
+		loop = findparam(layer, 'bline').find('bline').get('loop') == 'true'
+		composites = [composites[i]
+				for i in simplifypoints(composites, tolerance, loop)]
+	points = [exportnode(c, 'point', (prefix + 'point%d', i))
+			for i, c in enumerate(composites)]
+	n = range(len(points))
+
+	window_translate = [graph.substract_vector(points[i], rig['window_midleft'],
+			label=(prefix + 'point%d_window_translate', i)) for i in n]
+
+	window_translate_x = []
+	window_translate_y = []
+	for i in n:
+		window_translate_x.append(graph.vectorx(window_translate[i],
+				label=(prefix + 'point%d_window_translate_x', i)))
+		window_translate_y.append(graph.vectory(window_translate[i],
+				label=(prefix + 'point%d_window_translate_y', i)))
+
+	window_translate_x_scale = [graph.scale_real(window_translate_x[i],
+			rig['window_span_x_reciprocal'],
+			label=(prefix + 'point%d_window_translate_x_scale', i)) for i in n]
+
+	window = [graph.composite(window_translate_x_scale[i], window_translate_y[i],
+			label=(prefix + 'point%d_window', i)) for i in n]
+
+	window_x = []
+	window_y = []
+	for i in n:
+		window_x.append(graph.vectorx(window[i],
+				label=(prefix + 'point%d_window_x', i)))
+		window_y.append(graph.vectory(window[i],
+				label=(prefix + 'point%d_window_y', i)))
+
+	pointtuples = list(ntuples(list(n), 2))
+	if control is None:
+		# Segment01 and Segment12 exports
+		segment = {}
+		for s, start, length in (('segment01', 'P0', 'P1_minus_P0_length'),
+				('segment12', 'P1', 'P2_minus_P1_length')):
+			x_scale = [graph.scale_real(window_x[i], rig[length],
+					label=(prefix + s + '_point%d_window_x_scale', i)) for i in n]
+
+			segment_i = [graph.scale_vector(rig[s + '_i'], x_scale[i],
+					label=(prefix + s + '_point%d_i', i)) for i in n]
+
+			segment_j = [graph.scale_vector(rig[s + '_j'], window_y[i],
+					label=(prefix + s + '_point%d_j', i)) for i in n]
+
+			i_plus_j = [graph.add_vector(segment_i[i], segment_j[i],
+					label=(prefix + s + '_point%d_i_plus_j', i)) for i in n]
+
+			segment[s, 'point'] = [graph.add_vector(rig[start], i_plus_j[i],
+					label=(prefix + s + '_point%d', i)) for i in n]
+
+		# Deformed curve exports
+		phase('curve exports')
+		for s in ('segment01', 'segment12'):
+			segment[s, 'midpoint'] = [graph.add_vector(segment[s, 'point'][a],
+					segment[s, 'point'][b], 0.5,
+					label=(prefix + s + '_midpoint%d', a)) for a, b in pointtuples]
+
+		# Curve t parameter exports
+		t = {}
+		t['t_start'] = [graph.reference_real(window_x[a],
+				label=(prefix + 'curve%d_t_start', a)) for a, b in pointtuples]
+
+		t['one_minus_t_start'] = [graph.substract_real(1.0, t['t_start'][a],
+				label=(prefix + 'curve%d_one_minus_t_start', a)) for a, b in pointtuples]
+
+		t['t_end'] = [graph.reference_real(window_x[b],
+				label=(prefix + 'curve%d_t_end', a)) for a, b in pointtuples]
+
+		t['one_minus_t_end'] = [graph.substract_real(1.0, t['t_end'][a],
+				label=(prefix + 'curve%d_one_minus_t_end', a)) for a, b in pointtuples]
+
+		t['t_mid'] = [graph.add_real(window_x[a], window_x[b], 0.5,
+				label=(prefix + 'curve%d_t_mid', a)) for a, b in pointtuples]
+
+		t['one_minus_t_mid'] = [graph.substract_real(1.0, t['t_mid'][a],
+				label=(prefix + 'curve%d_one_minus_t_mid', a)) for a, b in pointtuples]
+
+		# Curve startpoint, endpoint and midpoint exports
+		curve = {}
+		for c, first, ct in (('startpoint', 'point', 't_start'),
+				('endpoint', 'point', 't_end'),
+				('midpoint', 'midpoint', 't_mid')):
+			# The endpoint of a curve sits on the next deformee point
+			at = [b if c == 'endpoint' else a for a, b in pointtuples]
+
+			lhs = [graph.scale_vector(segment['segment01', first][at[a]],
+					t['one_minus_' + ct][a],
+					label=(prefix + 'curve%d_' + c + '_lhs', a)) for a, b in pointtuples]
+
+			rhs = [graph.scale_vector(segment['segment12', first][at[a]], t[ct][a],
+					label=(prefix + 'curve%d_' + c + '_rhs', a)) for a, b in pointtuples]
+
+			curve[c] = [graph.add_vector(lhs[a], rhs[a],
+					label=(prefix + 'curve%d_' + c, a)) for a, b in pointtuples]
+	else:
+		phase('curve exports')
+		curve = pathcurves(points, window_x, window_y, rig, control, prefix)
+
+	# Curve controlpoint exports
+	controlpoint_lhs = [graph.scale_vector(curve['midpoint'][a], 4.0,
+			label=(prefix + 'curve%d_controlpoint_lhs', a)) for a, b in pointtuples]
+
+	controlpoint_rhs = [graph.add_vector(curve['startpoint'][a], curve['endpoint'][a],
+			label=(prefix + 'curve%d_controlpoint_rhs', a)) for a, b in pointtuples]
+
+	controlpoint = [graph.substract_vector(controlpoint_lhs[a], controlpoint_rhs[a],
+			0.5, label=(prefix + 'curve%d_controlpoint', a)) for a, b in pointtuples]
+
+	# Tangent exports
+	phase('tangent exports')
+	tangent1 = {}
+	tangent2 = {}
+	for a, b in ntuplesrotated(list(n), 2):
+		tangent1[b] = graph.substract_vector(curve['startpoint'][b], controlpoint[a],
+				2.0, label=(prefix + 'curve%d_tangent1', b))
+		tangent2[b] = graph.substract_vector(controlpoint[b], curve['startpoint'][b],
+				2.0, label=(prefix + 'curve%d_tangent2', b))
+
+	# Connect to deformed layer
+	phase('layer connection')
+	deformed_bline = findparam(deformed, 'bline').find('bline')
+	for entry in deformed_bline.findall('entry'):
+		deformed_bline.remove(entry)
+
+	for i in n:
+		deformed_bline.append(linkbuilt(bline_entry(curve['startpoint'][i],
+				tangent1[i], tangent2[i], split=True)))
+
+def selectlayers(root, patterns):
+	"Find top level deformable layers with a desc matching any pattern"
+	layers = []
+	for layer in root.findall('layer'):
+		desc = layer.get('desc', '')
+		if layer.get('type') not in deformabletypes or desc in generateddescs:
+			continue
+		for pattern in patterns:
+			if fnmatch.fnmatchcase(desc, pattern):
+				layers.append(layer)
+				break
+	return layers
+
+def packfragment(elems, nodes):
+	"Serialize elements and graph nodes together with the links between them"
+	global uses
+	# Source elements go as text, lxml elements can't be pickled
+	for node in nodes:
+		if node.tag is None:
+			node.links = ET.tostring(node.links)
+	links = []
+	index = 0
+	for elem in elems:
+		for e in et_iter(elem):
+			for attrib, node in uses.get(e, ()):
+				links.append((index, attrib, node))
+			index += 1
+	return ([ET.tostring(e) for e in elems], nodes, links)
+
+def unpackfragment(fragment, base):
+	"Load elements and graph nodes serialized by packfragment()"
+	global graph
+	xmls, nodes, links = fragment
+	elems = [ET.fromstring(x) for x in xmls]
+	for node in nodes:
+		if node.tag is None:
+			node.links = ET.fromstring(node.links)
+	found = [e for elem in elems for e in et_iter(elem)]
+	remap = graph.graft(nodes, base)
+	for index, attrib, node in links:
+		linkuse(found[index], attrib, remap.get(node, node))
+	return elems
+
+def buildlayer(work):
+	"Build the point subgraph of one layer, in a worker process"
+	global graph
+	global uses
+	layer_xml, deformed_xml, prefix, rig, control, tolerance, base = work
+
+	# The rig itself lives in the parent process, only its ids are needed
+	graph = Graph()
+	graph.nodes = [None] * base
+	uses = {}
+
+	layer = ET.fromstring(layer_xml)
+	deformed = ET.fromstring(deformed_xml)
+	deformlayer(layer, deformed, rig, prefix, control, tolerance)
+	return packfragment([layer, deformed], graph.nodes[base:])
+
+def canvasframes(root, stride=1):
+	"List the frames of the canvas time range every stride frames, with the last one"
+	fps = float(root.get('fps', '24'))
+	begin = int(round(parsetime(root.get('begin-time', '0f'), fps) * fps))
+	end = int(round(parsetime(root.get('end-time', '5s'), fps) * fps))
+	frames = list(range(begin, end + 1, max(1, stride)))
+	if frames[-1] != end:
+		frames.append(end)
+	return fps, frames
+
+def bakedvalue(series, waypoints):
+	"Constant vector if series (frames, 2) does not move, else an animated one"
+	if bake.np.allclose(series, series[0]):
+		return tuple(series[0])
+	return animated_vector(zip(waypoints, series))[0]
+
+def blinecomposites(layer, ids):
+	"Find the bline_point composites of the bline parameter of a layer"
+	bline = usevalue(findparam(layer, 'bline'), ids)
+	return [usevalue(entry, ids) for entry in bline.findall('entry')]
+
+def bakelayers(tree, layers, stride=None):
+	"""Replace the bline of each Deformed layer with its evaluated vectors
+
+	With a stride, the rig is sampled every stride frames over the canvas
+	time range and the vectors that move get linear waypoints.
+	"""
+	root = tree.getroot()
+	if bake.np is None:
+		print("bakelayers: NumPy is required to bake the rig")
+		raise SystemExit
+	ids = canvasdefs(root)
+	rig = dict((l.get('desc'), l) for l in root.findall('layer')
+			if l.get('desc') in ('Window', 'ControlBezier'))
+	deformed_layers = [l for l in root.findall('layer')
+			if l.get('desc') == 'Deformed']
+	if 'Window' not in rig or not deformed_layers:
+		print("bakelayers: No rig found, the file has to be processed first")
+		raise SystemExit
+
+	times = None
+	if stride:
+		fps, frames = canvasframes(root, stride)
+		times = bake.np.array(frames, dtype=float) / fps
+		waypoints = ['%df' % frame for frame in frames]
+
+	# Rigs following a path layer have no ControlBezier layer
+	controls = []
+	if 'ControlBezier' in rig:
+		controls = [linkvalue(c, 'point', ids)
+				for c in blinecomposites(rig['ControlBezier'], ids)]
+	quadratic = len(controls) == 3
+	if quadratic and len(deformed_layers) != len(layers):
+		print("bakelayers: %d layers selected for %d Deformed layers" %
+				(len(layers), len(deformed_layers)))
+		raise SystemExit
+	if quadratic:
+		sources = [[linkvalue(c, 'point', ids) for c in blinecomposites(layer, ids)]
+				for layer in layers]
+		# The points --simplify left out of the rig are only followed by
+		# the graphs of the Deformed layers
+		quadratic = all(len(points) == len(blinecomposites(deformed, ids))
+				for points, deformed in zip(sources, deformed_layers))
+	if quadratic:
+		# Read the whole rig and all source points with one program
+		window = rig['Window']
+		outputs = [usevalue(findparam(window, 'point1'), ids),
+				usevalue(findparam(window, 'point2'), ids)] + controls
+		sizes = []
+		for points in sources:
+			sizes.append(len(points))
+			outputs += points
+	else:
+		# A control path or a simplified rig has no closed form here, run
+		# the deformed layers' graphs
+		outputs = []
+		sizes = []
+		for points in evaluator.deformedoutputs(root, ids):
+			sizes.append(len(points))
+			outputs += points
+	program = evaluator.compilegraph(root, outputs, ids)
+	if program.animated and not stride:
+		print("bakelayers: The rig is animated, bake it with --mode bake-animated")
+		raise SystemExit
+	values = evaluator.run(program, times).swapaxes(0, 1)
+	if quadratic:
+		window = bake.np.concatenate((values[:, 0], values[:, 1]), -1)
+		controls = values[:, 2:5]
+		start = 5
+	else:
+		start = 0
+
+	for size, deformed in zip(sizes, deformed_layers):
+		# Every point of every frame in one batch
+		points = values[:, start:start + size]
+		start += size
+		if quadratic:
+			vertices, tangents1, tangents2 = bake.deform(points, window, controls)
+		else:
+			vertices, tangents1, tangents2 = [points[:, k::3] for k in range(3)]
+		bline = usevalue(findparam(deformed, 'bline'), ids)
+		entries = bline.findall('entry')
+		for entry in entries:
+			bline.remove(entry)
+		# One series of frames per vector
+		vertices, tangents1, tangents2 = [v.swapaxes(0, 1)
+				for v in (vertices, tangents1, tangents2)]
+		for point, t1, t2 in zip(vertices, tangents1, tangents2):
+			if stride:
+				point, t1, t2 = [bakedvalue(v, waypoints) for v in (point, t1, t2)]
+			else:
+				point, t1, t2 = tuple(point[0]), tuple(t1[0]), tuple(t2[0])
+			entry = bline_entry(point, t1, t2, split=True)[0]
+			if len(entries) == len(vertices):
+				# Keep the activepoints of the entry
+				entry.attrib.update(entries[len(bline)].attrib)
+			bline.append(entry)
+
+def minifyelem(elem):
+	"Drop the indentation and the trailing zeros of numbers in elem, recursively"
+	for e in elem.iter():
+		if len(e) and e.text and not e.text.strip():
+			e.text = None
+		if e.tail and not e.tail.strip():
+			e.tail = None
+		if e.tag in ('real', 'angle') and 'value' in e.attrib:
+			e.set('value', trimnumber(e.get('value')))
+		elif e.tag == 'vector':
+			for c in e:
+				if c.tag in ('x', 'y') and c.text:
+					c.text = trimnumber(c.text)
+
+def replacenode(root, old, new):
+	"Put new element in place of old one among the children of root"
+	new.tail = old.tail
+	root.insert(list(root).index(old), new)
+	root.remove(old)
+
+def prefixof(k):
+	"Prefix of the names of the nodes of the k-th rigged layer"
+	return 'layer%d_' % k if k else ''
+
+def rigkeys(control):
+	"Keys of the rig nodes deformlayer() links the points to"
+	keys = ['window_midleft', 'window_span_x_reciprocal']
+	if control is None:
+		return keys + ['P0', 'P1', 'P1_minus_P0_length', 'P2_minus_P1_length',
+				'segment01_i', 'segment01_j', 'segment12_i', 'segment12_j']
+	degree, spans = control
+	for m in range(degree * len(spans)):
+		keys += ['P%d' % m, 'P%d_minus_P%d_length' % (m + 1, m),
+				'leg%d_i' % m, 'leg%d_j' % m]
+	return keys
+
+def readrig(root):
+	"The rig recorded by writerig() in the canvas, or None"
+	for meta in root.findall('meta'):
+		if meta.get('name') != rigmeta:
+			continue
+		try:
+			state = json.loads(meta.get('content', ''))
+		except ValueError:
+			print("readrig: Cannot read the rig recorded in the canvas")
+			raise SystemExit
+		if state['control'] is not None:
+			degree, spans = state['control']
+			state['control'] = (degree, [tuple(span) for span in spans])
+		return state
+	return None
+
+def writerig(root, state):
+	"""Record the rig in the canvas meta data, ahead of the defs and layers
+
+	state holds the salt of the GUIDs of the rig, its control path, the
+	names of the rig nodes exported under another name than their key,
+	and a fingerprint of the points of each rigged layer.
+	"""
+	content = json.dumps(state, sort_keys=True, separators=(',', ':'))
+	for meta in root.findall('meta'):
+		if meta.get('name') == rigmeta:
+			meta.set('content', content)
+			return
+	position = len(root)
+	for n, child in enumerate(root):
+		if child.tag in ('keyframe', 'defs', 'bones', 'layer'):
+			position = n
+			break
+	meta = ET.Element('meta', {'name': rigmeta, 'content': content})
+	meta.tail = root[position - 1].tail if position else root.text
+	root.insert(position, meta)
+
+def pointguids(state):
+	"Map the GUIDs of the source points of every rigged layer to their names"
+	names = {}
+	for k, layer in enumerate(state['layers']):
+		for i in range(layer['count']):
+			name = prefixof(k) + 'point%d' % i
+			names[nameguid(name)] = name
+	return names
+
+def pointnames(layer, guidnames):
+	"Name of the rig node linked from each bline entry of layer in the file, or '-'"
+	names = []
+	for entry in findparam(layer, 'bline').find('bline').findall('entry'):
+		composite = entry.find('composite')
+		name = None
+		if composite is not None and 'point' in composite.attrib:
+			name = composite.get('point').lstrip(':')
+			if not pointname.match(name):
+				name = None
+		elif composite is not None and composite.find('point') is not None:
+			point = composite.find('point')
+			if len(point):
+				name = guidnames.get(point[0].get('guid'))
+		names.append(name or '-')
+	return names
+
+def builtnames(layer):
+	"pointnames() of a layer just built, as it will be written"
+	global graph
+	global uses
+	names = []
+	for entry in findparam(layer, 'bline').find('bline').findall('entry'):
+		node = dict(uses.get(entry.find('composite'), ())).get('point')
+		names.append('-' if node is None else labelname(graph.nodes[node].label))
+	return names
+
+def fingerprint(names):
+	"Short digest of the pointnames() of a layer, recorded by writerig()"
+	return hashlib.md5('|'.join(names).encode('utf-8')).hexdigest()[:16]
+
+def reachabledefs(elems, ids):
+	"Ids of the exported values linked from elems, directly or through others"
+	found = set()
+	stack = list(elems)
+	while stack:
+		for e in stack.pop().iter():
+			for key, value in e.attrib.items():
+				name = value.lstrip(':')
+				if key not in ('id', 'guid', 'desc', 'type', 'name') and name in ids \
+						and name not in found:
+					found.add(name)
+					stack.append(ids[name])
+	return found
+
+def unlinkpoints(layer, ids, guidnames):
+	"""Put plain copies of the rigged source points back in their entries
+
+	Returns the ids of the exported points the layer linked.
+	"""
+	unlinked = set()
+	for entry in findparam(layer, 'bline').find('bline').findall('entry'):
+		composite = entry.find('composite')
+		if composite is None:
+			continue
+		name = composite.get('point', '').lstrip(':')
+		if pointname.match(name) and name in ids:
+			value = xmldup_r(ids[name])
+			value.attrib.pop('id', None)
+			point = ET.SubElement(composite, 'point')
+			point.append(value)
+			# Moved rather than copied, lxml elements have one parent
+			composite.remove(point)
+			composite.insert(0, point)
+			del composite.attrib['point']
+			unlinked.add(name)
+		elif composite.find('point') is not None and len(composite.find('point')):
+			value = composite.find('point')[0]
+			if value.get('guid') in guidnames:
+				del value.attrib['guid']
+	return unlinked
+
+def reuserig(root, state, layers=None):
+	"""Find the rig built by an earlier run and the layers to build again
+
+	Returns the rig, made of graph nodes standing for its values in the
+	file, and (layer, deformed, k) for each rigged layer whose bline points
+	changed and each selected layer not rigged yet. Returns None when
+	there is nothing to build. The exported values of the old points of
+	the changed layers are dropped from the defs.
+	"""
+	global graph
+	ids = canvasdefs(root)
+	deformed_layers = [l for l in root.findall('layer') if l.get('desc') == 'Deformed']
+	if len(deformed_layers) != len(state['layers']):
+		print("reuserig: The rig has %d Deformed layers, the canvas %d" %
+				(len(state['layers']), len(deformed_layers)))
+		raise SystemExit
 
-	defs = {}
-	defs_keys = []
-	defs_usage = {}
+	# Rigged layers are known by the names of the rig nodes their points link
+	guidnames = pointguids(state)
+	found = {}
+	new = []
+	for layer in layers or selectlayers(root, ['*']):
+		names = [name for name in pointnames(layer, guidnames) if name != '-']
+		if names:
+			found.setdefault(int(pointname.match(names[0]).group(1) or 0), layer)
+		elif layers:
+			new.append(layer)
+	changed = [k for k in sorted(found)
+			if fingerprint(pointnames(found[k], guidnames)) != state['layers'][k]['points']]
+	if not changed and not new:
+		return None
+
+	rig = {}
+	guidelems = None
+	for key in rigkeys(state['control']):
+		name = state['aliases'].get(key, key)
+		if name in ids:
+			rig[key] = graph.extern(name)
+			continue
+		# Inlined rig nodes are found by their GUID
+		if guidelems is None:
+			guidelems = dict((e.get('guid'), e) for e in root.iter() if 'guid' in e.attrib)
+		elem = guidelems.get(nameguid(name))
+		if elem is None:
+			print("reuserig: The rig value '%s' is missing" % name)
+			raise SystemExit
+		rig[key] = graph.element(xmldup_r(elem), name)
+
+	work = []
+	stale = set()
+	for k in changed:
+		stale |= reachabledefs([findparam(deformed_layers[k], 'bline')], ids)
+		stale |= unlinkpoints(found[k], ids, guidnames)
+		work.append((found[k], deformed_layers[k], k))
+	for layer in new:
+		deformed = xmldup_r(layer)
+		deformed.set('desc', 'Deformed')
+		root.append(deformed)
+		work.append((layer, deformed, len(state['layers'])))
+		state['layers'].append(None)
+
+	# Drop the exported values only the old points of the changed layers used
+	externs = [node.links for node in graph.nodes if node.tag == 'extern']
+	others = [ids[name] for name in externs]
+	for layer in root.findall('layer'):
+		if any(layer is deformed for l, deformed, k in work):
+			others += [p for p in layer.findall('param') if p.get('name') != 'bline']
+		else:
+			others.append(layer)
+	stale -= reachabledefs(others, ids) | set(externs)
+	defs_section = root.find('defs')
+	for name in stale:
+		defs_section.remove(ids[name])
+	return rig, work
+
+def defaultlayers(tree, pathlayer=None):
+	"Layers deformed when none are selected: the first one besides the path"
+	return [layer for layer in et_iter(tree, tag='layer')
+			if layer is not pathlayer][:1]
+
+def layerslots(root, layers):
+	"Where each layer sits, as its parent and its index among the layers there"
+	return [(parent, parent.findall('layer').index(layer))
+			for parent, layer in zip(xmlbackend.parents(root, layers), layers)]
+
+def canonicalparts(elem, parts):
+	"Append the XML of elem to parts with sorted attributes and stripped text"
+	attrib = ''.join(' %s="%s"' % (k, escapeattrib(v))
+			for k, v in sorted(elem.attrib.items()))
+	parts.append('<%s%s>%s' % (elem.tag, attrib, escapetext((elem.text or '').strip())))
+	for child in elem:
+		canonicalparts(child, parts)
+		parts.append(escapetext((child.tail or '').strip()))
+	parts.append('</%s>' % elem.tag)
+	return parts
+
+def cachekey(root, inputs, options):
+	"""Key of the rig fragment built from the input layers with options
+
+	The layers and the exported values they link to are canonicalized, so
+	whitespace and attribute order don't matter. The ids the canvas
+	exports are part of the key, as the rig is named around them.
+	"""
+	ids = canvasdefs(root)
+	settings = [options.mode, options.control, options.segments,
+			options.path is not None, options.simplify, options.precision,
+			options.minify, options.readable_names, options.budget,
+			options.over_budget]
+	parts = [str(cacheversion), json.dumps(settings, sort_keys=True)]
+	for elem in inputs + [ids[name] for name in sorted(reachabledefs(inputs, ids))]:
+		parts.append(''.join(canonicalparts(elem, [])))
+	return cache.digest(parts + sorted(ids))
+
+def cachefragment(root, slots, layercount, defcount, stream):
+	"""Serialize what process() built in the tree, see splicefragment()
+
+	slots are the layerslots() of the input layers, layercount and defcount
+	the numbers of top level layers and of defs before process() ran.
+	"""
+	global shared
+	def render(elem):
+		if stream:
+			text = io.StringIO()
+			writeelem(text, elem, False)
+			return [text.getvalue(), elem.tail]
+		tail = elem.tail
+		elem.tail = None
+		text = ET.tostring(elem, encoding='unicode')
+		elem.tail = tail
+		return [text, tail]
+
+	fragment = {'inputs': [], 'layers': [], 'defs': []}
+	for parent, index in slots:
+		fragment['inputs'].append(render(parent.findall('layer')[index]))
+	for layer in root.findall('layer')[layercount:]:
+		fragment['layers'].append(render(layer))
+	if stream:
+		for i in sorted(shared):
+			text = io.StringIO()
+			writedef(text, i)
+			fragment['defs'].append([text.getvalue(), None])
+	elif root.find('defs') is not None:
+		fragment['defs'] = [render(elem) for elem in root.find('defs')[defcount:]]
+	fragment['rig'] = readrig(root)
+	return fragment
+
+def splicefragment(root, slots, fragment, stream=False):
+	"""Put a fragment made by cachefragment() in place of the input layers
+
+	With stream, the fragment isn't parsed: writesif() writes its text as
+	it is, and the tree only holds empty elements standing for it.
+	"""
+	global graph
+	global uses
+	global shared
+	global verbatim
+	graph = Graph()
+	uses = {}
+	shared = {}
+	verbatim = {}
+	def load(item, tag):
+		if stream:
+			elem = ET.Element(tag)
+			verbatim[elem] = item[0]
+		else:
+			elem = ET.fromstring(item[0])
+		elem.tail = item[1]
+		return elem
+
+	for (parent, index), item in zip(slots, fragment['inputs']):
+		replacenode(parent, parent.findall('layer')[index], load(item, 'layer'))
+	for item in fragment['layers']:
+		root.append(load(item, 'layer'))
+	if fragment['defs']:
+		defs_section = defssection(root)
+		for item in fragment['defs']:
+			defs_section.append(load(item, 'def'))
+	writerig(root, fragment['rig'])
+
+def process(tree, mode='inline', stream=False, layers=None, jobs=1, stride=1,
+		budget=None, overbudget='warn', readablenames=False, control='quadratic',
+		segments=1, pathlayer=None, simplify=None, precision=None, minify=False):
+	"""Process XML on given tree object
+
+	With a pathlayer, that spline layer of the tree is the control path
+	instead of a new ControlBezier layer, and control and segments are not
+	used. With simplify, points within that distance of the outline through
+	their neighbours are left out of the rig. precision maps constant types
+	to the digits written for the values the rig adds, and minify drops the
+	indentation and the trailing zeros of numbers in the whole output.
+
+	A tree processed before keeps its rig, see writerig(): only the layers
+	whose points changed since and the selected layers not rigged yet are
+	built, with the control path of the rig. Returns False when there is
+	nothing to build.
+	"""
+	global graph
+	global uses
+	global shared
+	global guids
+	global texts
+	global lowered
+	global readable
+	global rigsalt
+	global reserved
+
+	if mode not in outputmodes:
+		print("process: Unknown output mode '%s'" % mode)
+		raise SystemExit
+	if control not in controltypes:
+		print("process: Unknown control type '%s'" % control)
+		raise SystemExit
+	if segments < 1:
+		print("process: A control path needs at least one segment")
+		raise SystemExit
+	# The single quadratic curve keeps the original rig and names
+	path = None
+	if control != 'quadratic' or segments > 1:
+		path = (controltypes[control], [(float(k) / segments, float(segments))
+				for k in range(segments)])
+
+	graph = Graph()
+	uses = {}
+	shared = {}
+	guids = {}
+	texts = {}
+	lowered = {}
+	readable = readablenames
+	setprecision(precision, minify)
 	pp = pprint.PrettyPrinter(indent=4)
 
-	firstlayer = next(et_iter(tree, tag='layer'))
+	state = None
+	if mode not in ('bake', 'bake-animated'):
+		state = readrig(tree.getroot())
+	if state is not None:
+		rigsalt = state['salt']
+		found = reuserig(tree.getroot(), state, layers)
+		if found is None:
+			return False
+		rig, work = found
+		path = state['control']
+		reserved = set(canvasdefs(tree.getroot()))
+		return buildrig(tree, mode, state, rig, work, path, stream, jobs,
+				budget, overbudget, simplify, minify)
+
+	if not layers:
+		layers = defaultlayers(tree, pathlayer)
+
+	if mode in ('bake', 'bake-animated'):
+		phase('bake')
+	if mode == 'bake':
+		bakelayers(tree, layers)
+	elif mode == 'bake-animated':
+		bakelayers(tree, layers, stride)
+	if mode in ('bake', 'bake-animated'):
+		if minify:
+			minifyelem(tree.getroot())
+		return
+
+	if not layers:
+		print("process: No layers to rig")
+		raise SystemExit
 
 	# Append new layers to canvas
+	phase('layer copies')
 	window_rectangle = xmldup_r(nodedict['layer_rectangle'])
-	control_outline = xmldup_r(nodedict['layer_outline'])
+	control_outline = None
+	if pathlayer is None:
+		control_outline = xmldup_r(nodedict['layer_outline'])
 	# segment01_outline = xmldup_r(nodedict['layer_outline'])
 	# segment12_outline = xmldup_r(nodedict['layer_outline'])
-	deformed_outline = xmldup_r(firstlayer)
+	deformed_outlines = [xmldup_r(layer) for layer in layers]
 	window_rectangle.set('desc', 'Window')
-	control_outline.set('desc', 'ControlBezier')
 	# segment01_outline.set('desc', 'Segment01')
 	# segment12_outline.set('desc', 'Segment12')
-	deformed_outline.set('desc', 'Deformed')
 	tree.getroot().append(window_rectangle)
-	tree.getroot().append(control_outline)
+	if control_outline is not None:
+		control_outline.set('desc', 'ControlBezier')
+		tree.getroot().append(control_outline)
 	# tree.getroot().append(segment01_outline)
 	# tree.getroot().append(segment12_outline)
-	tree.getroot().append(deformed_outline)
-
-	# Wrap all child elements of all params inside a use element
-	paramwrap(tree.getroot())
+	for deformed_outline in deformed_outlines:
+		deformed_outline.set('desc', 'Deformed')
+		tree.getroot().append(deformed_outline)
 
 	# Window exports
-	window_left = exportnew(nodedict['real'], 'window_left')
-	window_bottom = exportnew(nodedict['real'], 'window_bottom')
-	window_right = exportnew(nodedict['real'], 'window_right')
-	window_top = exportnew(nodedict['real'], 'window_top')
-	window_left.attrib['value'] = '%.10f' % 0.0
-	window_bottom.attrib['value'] = '%.10f' % -0.5
-	window_right.attrib['value'] = '%.10f' % 1.0
-	window_top.attrib['value'] = '%.10f' % 0.5
-
-	window_mid_y = exportnew(nodedict['add_real'], 'window_mid_y')
-	window_mid_y.find('scalar/real').attrib['value'] = '%.10f' % 0.5
-	connectnode(window_mid_y.find('lhs'), window_mid_y, 'window_bottom')
-	connectnode(window_mid_y.find('rhs'), window_mid_y, 'window_top')
-
-	window_botleft = exportnew(nodedict['composite'], 'window_botleft')
-	window_topright = exportnew(nodedict['composite'], 'window_topright')
-	window_midleft = exportnew(nodedict['composite'], 'window_midleft')
-	window_midright = exportnew(nodedict['composite'], 'window_midright')
-	connectnode(window_botleft.find('x'), window_botleft, 'window_left')
-	connectnode(window_botleft.find('y'), window_botleft, 'window_bottom')
-	connectnode(window_topright.find('x'), window_topright, 'window_right')
-	connectnode(window_topright.find('y'), window_topright, 'window_top')
-	connectnode(window_midleft.find('x'), window_midleft, 'window_left')
-	connectnode(window_midleft.find('y'), window_midleft, 'window_mid_y')
-	connectnode(window_midright.find('x'), window_midright, 'window_right')
-	connectnode(window_midright.find('y'), window_midright, 'window_mid_y')
-
-	window_span_x = exportnew(nodedict['substract_real'], 'window_span_x')
-	connectnode(window_span_x.find('lhs'), window_span_x, 'window_right')
-	connectnode(window_span_x.find('rhs'), window_span_x, 'window_left')
-
-	window_span_x_reciprocal = exportnew(nodedict['reciprocal'], 'window_span_x_reciprocal')
-	connectnode(window_span_x_reciprocal.find('link'),
-			window_span_x_reciprocal, 'window_span_x')
+	phase('rig exports')
+	rig = {}
+	exportrig(rig, 'window_left', graph.real, 0.0)
+	exportrig(rig, 'window_bottom', graph.real, -0.5)
+	exportrig(rig, 'window_right', graph.real, 1.0)
+	exportrig(rig, 'window_top', graph.real, 0.5)
 
-	# Control Bezier exports
-	P2 = exportnew(nodedict['vector'], 'P2')
-	P1 = exportnew(nodedict['vector'], 'P1')
-	P0 = exportnew(nodedict['vector'], 'P0')
-
-	P1_minus_P0 = exportnew(nodedict['substract_vector'], 'P1_minus_P0')
-	P2_minus_P1 = exportnew(nodedict['substract_vector'], 'P2_minus_P1')
-	connectnode(P1_minus_P0.find('lhs'), P1_minus_P0, 'P1')
-	connectnode(P1_minus_P0.find('rhs'), P1_minus_P0, 'P0')
-	connectnode(P2_minus_P1.find('lhs'), P2_minus_P1, 'P2')
-	connectnode(P2_minus_P1.find('rhs'), P2_minus_P1, 'P1')
-
-	P1_minus_P0_length = exportnew(nodedict['vectorlength'], 'P1_minus_P0_length')
-	P2_minus_P1_length = exportnew(nodedict['vectorlength'], 'P2_minus_P1_length')
-	connectnode(P1_minus_P0_length.find('vector'), P1_minus_P0_length, 'P1_minus_P0')
-	connectnode(P2_minus_P1_length.find('vector'), P2_minus_P1_length, 'P2_minus_P1')
-
-	P1_minus_P0_length_reciprocal = exportnew(nodedict['reciprocal'],
-			'P1_minus_P0_length_reciprocal')
-	P2_minus_P1_length_reciprocal = exportnew(nodedict['reciprocal'],
-			'P2_minus_P1_length_reciprocal')
-	connectnode(P1_minus_P0_length_reciprocal.find('link'),
-			P1_minus_P0_length_reciprocal, 'P1_minus_P0_length')
-	connectnode(P2_minus_P1_length_reciprocal.find('link'),
-			P2_minus_P1_length_reciprocal, 'P2_minus_P1_length')
-
-	segment01_i = exportnew(nodedict['scale_vector'], 'segment01_i')
-	segment12_i = exportnew(nodedict['scale_vector'], 'segment12_i')
-	connectnode(segment01_i.find('link'), segment01_i, 'P1_minus_P0') 
-	connectnode(segment12_i.find('link'), segment12_i, 'P2_minus_P1') 
-	connectnode(segment01_i.find('scalar'), segment01_i, 'P1_minus_P0_length_reciprocal') 
-	connectnode(segment12_i.find('scalar'), segment12_i, 'P2_minus_P1_length_reciprocal') 
-
-	segment01_i_vectorx = exportnew(nodedict['vectorx'], 'segment01_i_vectorx')
-	segment01_i_vectory = exportnew(nodedict['vectory'], 'segment01_i_vectory')
-	segment12_i_vectorx = exportnew(nodedict['vectorx'], 'segment12_i_vectorx')
-	segment12_i_vectory = exportnew(nodedict['vectory'], 'segment12_i_vectory')
-	connectnode(segment01_i_vectorx.find('vector'), segment01_i_vectorx, 'segment01_i')
-	connectnode(segment01_i_vectory.find('vector'), segment01_i_vectory, 'segment01_i')
-	connectnode(segment12_i_vectorx.find('vector'), segment12_i_vectorx, 'segment12_i')
-	connectnode(segment12_i_vectory.find('vector'), segment12_i_vectory, 'segment12_i')
-
-	minus_segment01_i_vectory = exportnew(nodedict['substract_real'],
-			'minus_segment01_i_vectory')
-	minus_segment12_i_vectory = exportnew(nodedict['substract_real'],
-			'minus_segment12_i_vectory')
-	connectnode(minus_segment01_i_vectory.find('rhs'),
-			minus_segment01_i_vectory, 'segment01_i_vectory')
-	connectnode(minus_segment12_i_vectory.find('rhs'),
-			minus_segment12_i_vectory, 'segment12_i_vectory')
-
-	segment01_j = exportnew(nodedict['composite'], 'segment01_j')
-	segment12_j = exportnew(nodedict['composite'], 'segment12_j')
-	connectnode(segment01_j.find('x'), segment01_j, 'minus_segment01_i_vectory')
-	connectnode(segment01_j.find('y'), segment01_j, 'segment01_i_vectorx')
-	connectnode(segment12_j.find('x'), segment12_j, 'minus_segment12_i_vectory')
-	connectnode(segment12_j.find('y'), segment12_j, 'segment12_i_vectorx')
+	exportrig(rig, 'window_mid_y', graph.add_real, 'window_bottom', 'window_top', 0.5)
 
-	# Deformee exports
-	pointlist = getblinepoints(firstlayer)
-	pointlistenumerated = list(enumerate(pointlist))
-
-	for p in pointlistenumerated:
-		point = exportnode(p[1], tree.getroot(), 'point%04d' % p[0])
-
-	for p in pointlistenumerated:
-		point_window_translate = exportnew(nodedict['substract_vector'],
-				'point%04d_window_translate' % p[0])
-		connectnode(point_window_translate.find('lhs'), point_window_translate,
-				'point%04d' % p[0])
-		connectnode(point_window_translate.find('rhs'), point_window_translate,
-				'window_midleft')
-
-	for p in pointlistenumerated:
-		point_window_translate_x = exportnew(nodedict['vectorx'],
-				'point%04d_window_translate_x' % p[0])
-		point_window_translate_y = exportnew(nodedict['vectory'],
-				'point%04d_window_translate_y' % p[0])
-		connectnode(point_window_translate_x.find('vector'), point_window_translate_x,
-				'point%04d_window_translate' % p[0])
-		connectnode(point_window_translate_y.find('vector'), point_window_translate_y,
-				'point%04d_window_translate' % p[0])
-
-	for p in pointlistenumerated:
-		point_window_translate_x_scale = exportnew(nodedict['scale_real'],
-				'point%04d_window_translate_x_scale' % p[0])
-		connectnode(point_window_translate_x_scale.find('link'),
-				point_window_translate_x_scale,
-				'point%04d_window_translate_x' % p[0])
-		connectnode(point_window_translate_x_scale.find('scalar'),
-				point_window_translate_x_scale,
-				'window_span_x_reciprocal')
-
-	for p in pointlistenumerated:
-		point_window = exportnew(nodedict['composite'],
-				'point%04d_window' % p[0])
-		connectnode(point_window.find('x'), point_window,
-				'point%04d_window_translate_x_scale' % p[0])
-		connectnode(point_window.find('y'), point_window,
-				'point%04d_window_translate_y' % p[0])
-
-	for p in pointlistenumerated:
-		point_window_x = exportnew(nodedict['vectorx'], 'point%04d_window_x' % p[0])
-		point_window_y = exportnew(nodedict['vectory'], 'point%04d_window_y' % p[0])
-		connectnode(point_window_x.find('vector'), point_window_x,
-				'point%04d_window' % p[0])
-		connectnode(point_window_y.find('vector'), point_window_y,
-				'point%04d_window' % p[0])
-
-	# Segment01 exports
-	for p in pointlistenumerated:
-		segment01_point_window_x_scale = exportnew(nodedict['scale_real'],
-				'segment01_point%04d_window_x_scale' % p[0])
-		connectnode(segment01_point_window_x_scale.find('link'),
-				segment01_point_window_x_scale,
-				'point%04d_window_x' % p[0])
-		connectnode(segment01_point_window_x_scale.find('scalar'),
-				segment01_point_window_x_scale,
-				'P1_minus_P0_length')
-
-	for p in pointlistenumerated:
-		segment01_point_i = exportnew(nodedict['scale_vector'],
-				'segment01_point%04d_i' % p[0])
-		connectnode(segment01_point_i.find('link'), segment01_point_i,
-				'segment01_i')
-		connectnode(segment01_point_i.find('scalar'), segment01_point_i,
-				'segment01_point%04d_window_x_scale' % p[0])
-
-	for p in pointlistenumerated:
-		segment01_point_j = exportnew(nodedict['scale_vector'],
-				'segment01_point%04d_j' % p[0])
-		connectnode(segment01_point_j.find('link'), segment01_point_j,
-				'segment01_j')
-		connectnode(segment01_point_j.find('scalar'), segment01_point_j,
-				'point%04d_window_y' % p[0])
-
-	for p in pointlistenumerated:
-		segment01_point_i_plus_j = exportnew(nodedict['add_vector'],
-				'segment01_point%04d_i_plus_j' % p[0])
-		connectnode(segment01_point_i_plus_j.find('lhs'), segment01_point_i_plus_j,
-				'segment01_point%04d_i' % p[0])
-		connectnode(segment01_point_i_plus_j.find('rhs'), segment01_point_i_plus_j,
-				'segment01_point%04d_j' % p[0])
-
-	for p in pointlistenumerated:
-		segment01_point = exportnew(nodedict['add_vector'],
-				'segment01_point%04d' % p[0])
-		connectnode(segment01_point.find('lhs'), segment01_point, 'P0')
-		connectnode(segment01_point.find('rhs'), segment01_point,
-				'segment01_point%04d_i_plus_j' % p[0])
-
-	# Segment12 exports
-	for p in pointlistenumerated:
-		segment12_point_window_x_scale = exportnew(nodedict['scale_real'],
-				'segment12_point%04d_window_x_scale' % p[0])
-		connectnode(segment12_point_window_x_scale.find('link'),
-				segment12_point_window_x_scale,
-				'point%04d_window_x' % p[0])
-		connectnode(segment12_point_window_x_scale.find('scalar'),
-				segment12_point_window_x_scale,
-				'P2_minus_P1_length')
-
-	for p in pointlistenumerated:
-		segment12_point_i = exportnew(nodedict['scale_vector'],
-				'segment12_point%04d_i' % p[0])
-		connectnode(segment12_point_i.find('link'), segment12_point_i,
-				'segment12_i')
-		connectnode(segment12_point_i.find('scalar'), segment12_point_i,
-				'segment12_point%04d_window_x_scale' % p[0])
-
-	for p in pointlistenumerated:
-		segment12_point_j = exportnew(nodedict['scale_vector'],
-				'segment12_point%04d_j' % p[0])
-		connectnode(segment12_point_j.find('link'), segment12_point_j,
-				'segment12_j')
-		connectnode(segment12_point_j.find('scalar'), segment12_point_j,
-				'point%04d_window_y' % p[0])
-
-	for p in pointlistenumerated:
-		segment12_point_i_plus_j = exportnew(nodedict['add_vector'],
-				'segment12_point%04d_i_plus_j' % p[0])
-		connectnode(segment12_point_i_plus_j.find('lhs'), segment12_point_i_plus_j,
-				'segment12_point%04d_i' % p[0])
-		connectnode(segment12_point_i_plus_j.find('rhs'), segment12_point_i_plus_j,
-				'segment12_point%04d_j' % p[0])
-
-	for p in pointlistenumerated:
-		segment12_point = exportnew(nodedict['add_vector'],
-				'segment12_point%04d' % p[0])
-		connectnode(segment12_point.find('lhs'), segment12_point, 'P1')
-		connectnode(segment12_point.find('rhs'), segment12_point,
-				'segment12_point%04d_i_plus_j' % p[0])
-
-	# Deformed curve exports
-	pointtuples = list(ntuples(pointlistenumerated, 2))
-
-	for ptuple in pointtuples:
-		segment01_midpoint = exportnew(nodedict['add_vector'],
-				'segment01_midpoint%04d' % ptuple[0][0])
-		connectnode(segment01_midpoint.find('lhs'), segment01_midpoint,
-				'segment01_point%04d' % ptuple[0][0])
-		connectnode(segment01_midpoint.find('rhs'), segment01_midpoint,
-				'segment01_point%04d' % ptuple[1][0])
-		segment01_midpoint.find('scalar/real').set('value', '%.10f' % 0.5)
-
-	for ptuple in pointtuples:
-		segment12_midpoint = exportnew(nodedict['add_vector'],
-				'segment12_midpoint%04d' % ptuple[0][0])
-		connectnode(segment12_midpoint.find('lhs'), segment12_midpoint,
-				'segment12_point%04d' % ptuple[0][0])
-		connectnode(segment12_midpoint.find('rhs'), segment12_midpoint,
-				'segment12_point%04d' % ptuple[1][0])
-		segment12_midpoint.find('scalar/real').set('value', '%.10f' % 0.5)
-
-	# Curve t parameter exports
-	for ptuple in pointtuples:
-		curve_t_start = exportnew(nodedict['reference_real'],
-				'curve%04d_t_start' % ptuple[0][0])
-		connectnode(curve_t_start.find('link'), curve_t_start,
-				'point%04d_window_x' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_one_minus_t_start = exportnew(nodedict['substract_real'],
-				'curve%04d_one_minus_t_start' % ptuple[0][0])
-		connectnode(curve_one_minus_t_start.find('rhs'), curve_one_minus_t_start,
-				'curve%04d_t_start' % ptuple[0][0])
-		curve_one_minus_t_start.find('lhs/real').set('value', '%.10f' % 1.0)
-
-	for ptuple in pointtuples:
-		curve_t_end = exportnew(nodedict['reference_real'],
-				'curve%04d_t_end' % ptuple[0][0])
-		connectnode(curve_t_end.find('link'), curve_t_end,
-				'point%04d_window_x' % ptuple[1][0])
-
-	for ptuple in pointtuples:
-		curve_one_minus_t_end = exportnew(nodedict['substract_real'],
-				'curve%04d_one_minus_t_end' % ptuple[0][0])
-		connectnode(curve_one_minus_t_end.find('rhs'), curve_one_minus_t_end,
-				'curve%04d_t_end' % ptuple[0][0])
-		curve_one_minus_t_end.find('lhs/real').set('value', '%.10f' % 1.0)
-
-	for ptuple in pointtuples:
-		curve_t_mid = exportnew(nodedict['add_real'],
-				'curve%04d_t_mid' % ptuple[0][0])
-		connectnode(curve_t_mid.find('lhs'), curve_t_mid,
-				'point%04d_window_x' % ptuple[0][0])
-		connectnode(curve_t_mid.find('rhs'), curve_t_mid,
-				'point%04d_window_x' % ptuple[1][0])
-		curve_t_mid.find('scalar/real').set('value', '%.10f' % 0.5)
-
-	for ptuple in pointtuples:
-		curve_one_minus_t_mid = exportnew(nodedict['substract_real'],
-				'curve%04d_one_minus_t_mid' % ptuple[0][0])
-		connectnode(curve_one_minus_t_mid.find('rhs'), curve_one_minus_t_mid,
-				'curve%04d_t_mid' % ptuple[0][0])
-		curve_one_minus_t_mid.find('lhs/real').set('value', '%.10f' % 1.0)
-
-	# Curve startpoint exports
-	for ptuple in pointtuples:
-		curve_startpoint_lhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_startpoint_lhs' % ptuple[0][0])
-		connectnode(curve_startpoint_lhs.find('link'), curve_startpoint_lhs,
-				'segment01_point%04d' % ptuple[0][0])
-		connectnode(curve_startpoint_lhs.find('scalar'), curve_startpoint_lhs,
-				'curve%04d_one_minus_t_start' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_startpoint_rhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_startpoint_rhs' % ptuple[0][0])
-		connectnode(curve_startpoint_rhs.find('link'), curve_startpoint_rhs,
-				'segment12_point%04d' % ptuple[0][0])
-		connectnode(curve_startpoint_rhs.find('scalar'), curve_startpoint_rhs,
-				'curve%04d_t_start' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_startpoint = exportnew(nodedict['add_vector'],
-				'curve%04d_startpoint' % ptuple[0][0])
-		connectnode(curve_startpoint.find('lhs'), curve_startpoint,
-				'curve%04d_startpoint_lhs' % ptuple[0][0])
-		connectnode(curve_startpoint.find('rhs'), curve_startpoint,
-				'curve%04d_startpoint_rhs' % ptuple[0][0])
-
-	# Curve endpoint exports
-	for ptuple in pointtuples:
-		curve_endpoint_lhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_endpoint_lhs' % ptuple[0][0])
-		connectnode(curve_endpoint_lhs.find('link'), curve_endpoint_lhs,
-				'segment01_point%04d' % ptuple[1][0])
-		connectnode(curve_endpoint_lhs.find('scalar'), curve_endpoint_lhs,
-				'curve%04d_one_minus_t_end' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_endpoint_rhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_endpoint_rhs' % ptuple[0][0])
-		connectnode(curve_endpoint_rhs.find('link'), curve_endpoint_rhs,
-				'segment12_point%04d' % ptuple[1][0])
-		connectnode(curve_endpoint_rhs.find('scalar'), curve_endpoint_rhs,
-				'curve%04d_t_end' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_endpoint = exportnew(nodedict['add_vector'],
-				'curve%04d_endpoint' % ptuple[0][0])
-		connectnode(curve_endpoint.find('lhs'), curve_endpoint,
-				'curve%04d_endpoint_lhs' % ptuple[0][0])
-		connectnode(curve_endpoint.find('rhs'), curve_endpoint,
-				'curve%04d_endpoint_rhs' % ptuple[0][0])
-
-	# Curve midpoint exports
-	for ptuple in pointtuples:
-		curve_midpoint_lhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_midpoint_lhs' % ptuple[0][0])
-		connectnode(curve_midpoint_lhs.find('link'), curve_midpoint_lhs,
-				'segment01_midpoint%04d' % ptuple[0][0])
-		connectnode(curve_midpoint_lhs.find('scalar'), curve_midpoint_lhs,
-				'curve%04d_one_minus_t_mid' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_midpoint_rhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_midpoint_rhs' % ptuple[0][0])
-		connectnode(curve_midpoint_rhs.find('link'), curve_midpoint_rhs,
-				'segment12_midpoint%04d' % ptuple[0][0])
-		connectnode(curve_midpoint_rhs.find('scalar'), curve_midpoint_rhs,
-				'curve%04d_t_mid' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_midpoint = exportnew(nodedict['add_vector'],
-				'curve%04d_midpoint' % ptuple[0][0])
-		connectnode(curve_midpoint.find('lhs'), curve_midpoint,
-				'curve%04d_midpoint_lhs' % ptuple[0][0])
-		connectnode(curve_midpoint.find('rhs'), curve_midpoint,
-				'curve%04d_midpoint_rhs' % ptuple[0][0])
+	exportrig(rig, 'window_botleft', graph.composite, 'window_left', 'window_bottom')
+	exportrig(rig, 'window_topright', graph.composite, 'window_right', 'window_top')
+	exportrig(rig, 'window_midleft', graph.composite, 'window_left', 'window_mid_y')
+	exportrig(rig, 'window_midright', graph.composite, 'window_right', 'window_mid_y')
 
-	# Curve controlpoint exports
-	for ptuple in pointtuples:
-		curve_controlpoint_lhs = exportnew(nodedict['scale_vector'],
-				'curve%04d_controlpoint_lhs' % ptuple[0][0])
-		connectnode(curve_controlpoint_lhs.find('link'), curve_controlpoint_lhs,
-				'curve%04d_midpoint' % ptuple[0][0])
-		curve_controlpoint_lhs.find('scalar/real').set('value', '%.10f' % 4.0)
-
-	for ptuple in pointtuples:
-		curve_controlpoint_rhs = exportnew(nodedict['add_vector'],
-				'curve%04d_controlpoint_rhs' % ptuple[0][0])
-		connectnode(curve_controlpoint_rhs.find('lhs'), curve_controlpoint_rhs,
-				'curve%04d_startpoint' % ptuple[0][0])
-		connectnode(curve_controlpoint_rhs.find('rhs'), curve_controlpoint_rhs,
-				'curve%04d_endpoint' % ptuple[0][0])
-
-	for ptuple in pointtuples:
-		curve_controlpoint = exportnew(nodedict['substract_vector'],
-				'curve%04d_controlpoint' % ptuple[0][0])
-		connectnode(curve_controlpoint.find('lhs'), curve_controlpoint,
-				'curve%04d_controlpoint_lhs' % ptuple[0][0])
-		connectnode(curve_controlpoint.find('rhs'), curve_controlpoint,
-				'curve%04d_controlpoint_rhs' % ptuple[0][0])
-		curve_controlpoint.find('scalar/real').set('value', '%.10f' % 0.5)
+	exportrig(rig, 'window_span_x', graph.substract_real, 'window_right', 'window_left')
+	exportrig(rig, 'window_span_x_reciprocal', graph.reciprocal, 'window_span_x')
 
-	# Tangent exports
-	pointtuplesrotate = list(ntuplesrotated(pointlistenumerated, 2))
-
-	for ptuple in pointtuplesrotate:
-		curve_tangent1 = exportnew(nodedict['substract_vector'],
-				'curve%04d_tangent1' % ptuple[1][0])
-		connectnode(curve_tangent1.find('lhs'), curve_tangent1,
-				'curve%04d_startpoint' % ptuple[1][0])
-		connectnode(curve_tangent1.find('rhs'), curve_tangent1,
-				'curve%04d_controlpoint' % ptuple[0][0])
-		curve_tangent1.find('scalar/real').set('value', '%.10f' % 2.0)
-		curve_tangent2 = exportnew(nodedict['substract_vector'],
-				'curve%04d_tangent2' % ptuple[1][0])
-		connectnode(curve_tangent2.find('lhs'), curve_tangent2,
-				'curve%04d_controlpoint' % ptuple[1][0])
-		connectnode(curve_tangent2.find('rhs'), curve_tangent2,
-				'curve%04d_startpoint' % ptuple[1][0])
-		curve_tangent2.find('scalar/real').set('value', '%.10f' % 2.0)
+	# Control Bezier exports
+	if pathlayer is not None:
+		controls, spans = exportpath(rig, tree.getroot(), pathlayer)
+		path = (3, spans)
+		for m in range(len(controls) - 1):
+			exportleg(rig, 'leg%d' % m, controls[m], controls[m + 1])
+	elif path is None:
+		exportrig(rig, 'P2', graph.vector)
+		exportrig(rig, 'P1', graph.vector)
+		exportrig(rig, 'P0', graph.vector)
+		exportleg(rig, 'segment01', 'P0', 'P1')
+		exportleg(rig, 'segment12', 'P1', 'P2')
+		controls = ['P0', 'P1', 'P2']
+	else:
+		# The path starts out straight along the window midline
+		degree, spans = path
+		controls = ['P%d' % m for m in range(degree * len(spans) + 1)]
+		for m, name in enumerate(controls):
+			exportrig(rig, name, graph.vector, float(m) / (len(controls) - 1))
+		for m in range(len(controls) - 1):
+			exportleg(rig, 'leg%d' % m, controls[m], controls[m + 1])
 
 	# Connect to layers
+	phase('layer connection')
 	window_rectangle_point1 = findparam(window_rectangle, 'point1')
 	window_rectangle_point2 = findparam(window_rectangle, 'point2')
-	connectnode(window_rectangle_point1.find('use'), window_rectangle, 'window_botleft')
-	connectnode(window_rectangle_point2.find('use'), window_rectangle, 'window_topright')
-
-	control_outline_bline = findparam(control_outline, 'bline').find('use/bline')
-	control_outline_bline.set('loop', 'false')
-	control_outline_entry = control_outline_bline.find('entry')
-	connectnode(control_outline_entry.find('composite/point'),
-			control_outline_entry, 'P0')
-	control_outline_entry = xmldup_r(nodedict['bline_entry'])
-	connectnode(control_outline_entry.find('composite/point'),
-			control_outline_entry, 'P1')
-	control_outline_bline.append(control_outline_entry)
-	control_outline_entry = xmldup_r(nodedict['bline_entry'])
-	connectnode(control_outline_entry.find('composite/point'),
-			control_outline_entry, 'P2')
-	control_outline_bline.append(control_outline_entry)
+	connectnode(window_rectangle_point1, 'use', rig['window_botleft'])
+	connectnode(window_rectangle_point2, 'use', rig['window_topright'])
+
+	if control_outline is not None:
+		control_outline_bline = findparam(control_outline, 'bline').find('bline')
+		control_outline_bline.set('loop', 'false')
+		control_outline_entry = control_outline_bline.find('entry')
+		connectnode(control_outline_entry.find('composite'), 'point', rig[controls[0]])
+		for name in controls[1:]:
+			control_outline_bline.append(linkbuilt(bline_entry(rig[name])))
 
 	# segment01_outline_bline = findparam(segment01_outline, 'bline').find('use/bline')
 	# segment12_outline_bline = findparam(segment12_outline, 'bline').find('use/bline')
@@ -684,61 +1762,445 @@ def process(tree):
 		# segment01_outline_bline.append(segment01_entry)
 		# segment12_outline_bline.append(segment12_entry)
 
-	deformed_outline_bline = findparam(deformed_outline, 'bline').find('use/bline')
-	for entry in deformed_outline_bline.findall('entry'):
-		deformed_outline_bline.remove(entry)
-
-	for p in enumerate(pointlist):
-		deformed_entry = xmldup_r(nodedict['bline_entry'])
-		connectnode(deformed_entry.find('composite/point'), deformed_entry, 
-				'curve%04d_startpoint' % p[0])
-		connectnode(deformed_entry.find('composite/t1'), deformed_entry, 
-				'curve%04d_tangent1' % p[0])
-		connectnode(deformed_entry.find('composite/t2'), deformed_entry, 
-				'curve%04d_tangent2' % p[0])
-		deformed_outline_bline.append(deformed_entry)
-		deformed_entry.find('composite/split/bool').set('value', 'true')
-
-	# Unexport all exported values
-	for k in list(defs_keys):
-		unexportnode(k)
-
-	# Generate defs section
-	for k in defs_keys:
-		gendef(k, tree.getroot())
-
-	# Unwrap all child elements of all params inside a use element
-	paramunwrap(tree.getroot())
-
-if __name__ == "__main__":
-	# Open source SIF file
-	if len(sys.argv) < 2:
-		print("Not enough arguments")
-		raise SystemExit
-	else:
+	# Recorded in the file so that a later run can find the rig again
+	rigsalt = '%016x' % random.getrandbits(64)
+	reserved = set(canvasdefs(tree.getroot()))
+	state = {'salt': rigsalt, 'control': path, 'layers': [None] * len(layers),
+			'aliases': {}}
+	for key in rigkeys(path):
+		name = labelname(graph.nodes[rig[key]].label)
+		if name != key:
+			state['aliases'][key] = name
+	work = [(layer, deformed, k)
+			for k, (layer, deformed) in enumerate(zip(layers, deformed_outlines))]
+	return buildrig(tree, mode, state, rig, work, path, stream, jobs,
+			budget, overbudget, simplify, minify)
+
+def buildrig(tree, mode, state, rig, work, path, stream, jobs,
+		budget, overbudget, simplify, minify):
+	"""Build the points of the layers in work on the rig and write it out
+
+	work holds (layer, deformed, k) for the k-th rigged layer.
+	"""
+	global graph
+
+	# Deformee exports, each layer's names get their own prefix
+	if jobs > 1 and len(work) > 1:
+		import multiprocessing
+		phase('layer workers')
+		base = len(graph)
+		tasks = [(ET.tostring(layer), ET.tostring(deformed), prefixof(k), rig,
+				path, simplify, base) for layer, deformed, k in work]
+		pool = multiprocessing.Pool(min(jobs, len(work)))
 		try:
-			f = open(sys.argv[1])
-		except IOError:
-			print("Could not open file:", sys.argv[1])
-			raise SystemExit
+			fragments = pool.map(buildlayer, tasks)
+		finally:
+			pool.close()
+		for n, ((layer, deformed, k), fragment) in enumerate(zip(work, fragments)):
+			newlayer, newdeformed = unpackfragment(fragment, base)
+			replacenode(tree.getroot(), layer, newlayer)
+			replacenode(tree.getroot(), deformed, newdeformed)
+			work[n] = (newlayer, newdeformed, k)
+	else:
+		for layer, deformed, k in work:
+			deformlayer(layer, deformed, rig, prefixof(k), path, simplify)
+
+	if minify:
+		minifyelem(tree.getroot())
+		for node in graph.nodes:
+			if node.tag is None:
+				minifyelem(node.links)
+
+	# Pick the graph nodes kept as shared defs, the rest are inlined
+	phase('pick shared')
+	pickshared(mode)
+
+	for layer, deformed, k in work:
+		state['layers'][k] = {'points': fingerprint(builtnames(layer)),
+				'count': len(findparam(layer, 'bline').find('bline').findall('entry'))}
+	writerig(tree.getroot(), state)
+
+	# Check the size before anything is expanded
+	if budget is not None:
+		phase('budget')
+		mode = checkbudget(tree.getroot(), mode, budget, overbudget)
+
+	if stream:
+		# writesif() lowers the graph while serializing
+		return
+
+	# Lower the graph into the tree
+	phase('lower')
+	lowertree(tree.getroot())
+
+def processfile(path, options, jobs=1):
+	"Process SIF file in place with given command line options"
+	profiling = getattr(options, 'profile', None)
+	if profiling:
+		startprofile()
+		phase('parse')
+
+	# Open source SIF file, plain or gzip compressed
+	try:
+		compress = isgzip(path) or path.endswith('.sifz')
+		f = opensif(path)
+	except IOError:
+		print("Could not open file:", path)
+		raise SystemExit
 
 	# Parse into ElementTree
-	tree = ET.parse(f)
+	tree = xmlbackend.parse(f)
 	f.close()
 
-	# Main processing
-	try:
-		process(tree)
-	except:
-		traceback.print_exc()
-		raise SystemExit
+	# Pick the layers to deform
+	layers = None
+	if options.layers:
+		layers = selectlayers(tree.getroot(), options.layers)
+		if not layers:
+			print("No layer matches:", ", ".join(options.layers))
+			raise SystemExit
 
-	# Open output file
+	# Pick the layer used as the control path
+	pathlayer = None
+	if options.path and options.mode not in ('bake', 'bake-animated'):
+		pathlayers = selectlayers(tree.getroot(), [options.path])
+		if not pathlayers:
+			print("No path layer matches:", options.path)
+			raise SystemExit
+		pathlayer = pathlayers[0]
+		if layers:
+			layers = [layer for layer in layers if layer is not pathlayer]
+			if not layers:
+				print("No layer to deform besides the path layer")
+				raise SystemExit
+
+	# Look for the rig built from the same layers and options before
+	root = tree.getroot()
+	key = None
+	fragment = None
+	if getattr(options, 'cache', None) and \
+			options.mode not in ('bake', 'bake-animated') and readrig(root) is None:
+		phase('cache')
+		layers = layers or defaultlayers(tree, pathlayer)
+		inputs = layers + ([pathlayer] if pathlayer is not None else [])
+		slots = layerslots(root, inputs)
+		key = cachekey(root, inputs, options)
+		fragment = cache.load(options.cache, key)
+
+	if fragment is not None:
+		# The rest of the canvas is minified as process() would
+		setprecision(options.precision, options.minify)
+		if options.minify:
+			minifyelem(root)
+		splicefragment(root, slots, fragment, options.stream)
+		changed = True
+	else:
+		# Main processing
+		layercount = len(root.findall('layer'))
+		defcount = len(root.find('defs')) if root.find('defs') is not None else 0
+		changed = process(tree, options.mode, options.stream, layers, jobs,
+				options.stride, options.budget, options.over_budget,
+				options.readable_names, options.control, options.segments,
+				pathlayer, options.simplify, options.precision,
+				options.minify) is not False
+		# Rigs larger than the whole cache are not kept
+		if key is not None and options.stream and \
+				predictsize(root)[1] > options.cache_size:
+			key = None
+		if key is not None:
+			phase('cache')
+			fragment = cachefragment(root, slots, layercount, defcount,
+					options.stream)
+			cache.store(options.cache, key, fragment, options.cache_size)
+			if options.stream:
+				# Written from the text made for the cache, not a second time
+				for layer in root.findall('layer')[layercount:]:
+					root.remove(layer)
+				splicefragment(root, slots, fragment, True)
+
+	# The file is left alone when its rig is up to date
+	if not changed:
+		print("Rig is up to date:", path)
+	else:
+		# Open output file, compressed the same way as the input
+		with replacingsif(path, compress, options.compress_level) as f:
+			phase('write')
+			if options.stream:
+				writesif(tree, f)
+			else:
+				tree.write(f)
+
+	if profiling:
+		stopprofile(options.profile, {'file': path, 'mode': options.mode,
+				'stream': options.stream, 'graph_nodes': len(graph),
+				'shared_nodes': len(shared), 'bytes': os.path.getsize(path)})
+
+def batchfile(work):
+	"Process one file of a batch, returning the outcome instead of raising"
+	path, options = work
+	output = io.StringIO()
+	start = time.time()
 	try:
-		f = open(sys.argv[1], 'wb')
-	except IOError:
-		print("Could not open output file:", sys.argv[1])
-		raise SystemExit
-
-	tree.write(f)
+		with contextlib.redirect_stdout(output):
+			processfile(path, options)
+	except SystemExit:
+		# The reason was printed before exiting
+		return (path, time.time() - start, output.getvalue().strip())
+	except Exception:
+		error = output.getvalue() + traceback.format_exc(limit=-1)
+		return (path, time.time() - start, error.strip())
+	return (path, time.time() - start, None)
+
+def expandpaths(args):
+	"Expand directories and glob patterns into a list of SIF files"
+	paths = []
+	for arg in args:
+		if os.path.isdir(arg):
+			found = glob.glob(os.path.join(arg, '*.sif'))
+			found += glob.glob(os.path.join(arg, '*.sifz'))
+		elif glob.has_magic(arg):
+			found = glob.glob(arg)
+		else:
+			found = [arg]
+		for path in sorted(found):
+			if path not in paths:
+				paths.append(path)
+	return paths
+
+def processbatch(paths, options):
+	"Process many SIF files on a worker pool, reporting each one"
+	import multiprocessing
+	failed = 0
+	start = time.time()
+	pool = multiprocessing.Pool(max(1, min(options.jobs, len(paths))))
+	try:
+		work = [(path, options) for path in paths]
+		for path, seconds, error in pool.imap_unordered(batchfile, work):
+			if error:
+				failed += 1
+				print("FAILED %s (%.2fs)" % (path, seconds))
+				for line in error.splitlines():
+					print("    " + line)
+			else:
+				print("ok     %s (%.2fs)" % (path, seconds))
+			sys.stdout.flush()
+	finally:
+		pool.close()
+		pool.join()
+	print("%d files, %d failed, %.2fs" % (len(paths), failed, time.time() - start))
+	return failed
+
+def parsesize(text):
+	"Read a size in bytes like 500k, 100M or 2G"
+	units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+	try:
+		if text[-1:].lower() in units:
+			return int(float(text[:-1]) * units[text[-1].lower()])
+		return int(text)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid size: '%s'" % text)
+
+def parseprecision(text):
+	"Read digits per constant type like vector=4,real=6"
+	digits = {}
+	try:
+		for item in text.split(','):
+			type, value = item.split('=')
+			if type not in defaultprecision or not 0 <= int(value) <= 17:
+				raise ValueError
+			digits[type] = int(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid precision: '%s', expected "
+				"digits per type like vector=4,real=6,angle=3" % text)
+	return digits
+
+def runcommand(argv, cwd):
+	"Run a command line sent to the daemon, returning (exit status, output)"
+	output = io.StringIO()
+	status = 0
+	try:
+		os.chdir(cwd)
+		with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+			if '--serve' in argv:
+				print("runcommand: The daemon doesn't start other daemons")
+				raise SystemExit(1)
+			main(argv)
+	except SystemExit as e:
+		status = e.code if isinstance(e.code, int) else int(e.code is not None)
+	except Exception:
+		output.write(traceback.format_exc())
+		status = 1
+	return status, output.getvalue()
+
+def serve(path):
+	"""Run the command lines sent by deformclient.py over a Unix socket
+
+	Each one runs in a process forked from this one, which has imported
+	the modules and parsed the nodedict templates already. Runs until
+	interrupted or terminated.
+	"""
+	import signal
+	import socket
+	import socketserver
+
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			data = self.rfile.read()
+			# Connections probing for a daemon send nothing
+			if not data:
+				return
+			message = json.loads(data.decode('utf-8'))
+			status, output = runcommand(message['argv'], message['cwd'])
+			self.wfile.write(json.dumps({'status': status,
+					'output': output}).encode('utf-8'))
+
+	class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+		pass
+
+	def terminate(signum, frame):
+		raise KeyboardInterrupt
+
+	# A socket left behind by a daemon that is gone is replaced
+	if os.path.exists(path):
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+		except (IOError, OSError):
+			os.remove(path)
+		else:
+			print("serve: A daemon is listening on %s already" % path)
+			raise SystemExit(1)
+		finally:
+			probe.close()
+
+	# Templates are parsed on first use, parse them before forking
+	nodedict.values()
+
+	# Only the owner may connect
+	umask = os.umask(0o077)
+	try:
+		server = Server(path, Handler)
+	finally:
+		os.umask(umask)
+	signal.signal(signal.SIGTERM, terminate)
+	print("Serving on", path)
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(path)
+
+def makeparser():
+	"Parser of the command line options"
+	parser = argparse.ArgumentParser(
+			description="Add a free-form deformation rig to Synfig SIF files")
+	parser.add_argument('files', nargs='*', metavar='file',
+			help="SIF file to process in place; several files, directories "
+			"or glob patterns are processed as a batch. A file processed "
+			"before keeps its rig, only layers whose points changed and "
+			"selected layers not rigged yet are built again")
+	parser.add_argument('--no-stream', dest='stream', action='store_false',
+			help="build the whole output tree in memory before writing it")
+	parser.add_argument('--mode', choices=outputmodes, default='inline',
+			help="inline copies every exported value at each use (default), "
+			"shared keeps them in the canvas defs and references them by id, "
+			"dedup merges identical nodes and shares only repeated ones, "
+			"bake evaluates the rig of a processed file into plain vectors, "
+			"bake-animated samples an animated rig into keyed vectors "
+			"(both need NumPy)")
+	parser.add_argument('--stride', type=int, default=1, metavar='N',
+			help="with bake-animated, key every Nth frame of the canvas "
+			"time range, plus the last one (default 1)")
+	parser.add_argument('--control', choices=sorted(controltypes),
+			default='quadratic', help="degree of the control path segments "
+			"(default quadratic)")
+	parser.add_argument('--segments', type=int, default=1, metavar='N',
+			help="number of control path segments, each bending an equal part "
+			"of the window (default 1)")
+	parser.add_argument('--path', metavar='DESC',
+			help="use the first outline or region layer whose description "
+			"matches this pattern as the control path, instead of adding a "
+			"ControlBezier layer; --control and --segments are then unused")
+	parser.add_argument('--simplify', type=float, metavar='TOL',
+			help="leave out of the rig the points lying within TOL units of "
+			"the line through the points kept around them")
+	parser.add_argument('--precision', type=parseprecision, metavar='TYPE=N,...',
+			help="digits after the decimal point written for the real, angle "
+			"and vector values the rig adds (default real=10,angle=6,vector=10)")
+	parser.add_argument('--minify', action='store_true',
+			help="drop the indentation whitespace and the trailing zeros of "
+			"the real, angle and vector values of the whole file")
+	parser.add_argument('--compress-level', type=int, default=6,
+			choices=range(0, 10), metavar='0-9',
+			help="gzip level used when writing .sifz output (default 6)")
+	parser.add_argument('--layer', dest='layers', action='append', default=[],
+			metavar='DESC', help="deform the outline and region layers whose "
+			"description matches this pattern, may be given several times "
+			"(default: the first layer)")
+	parser.add_argument('--all-layers', dest='layers', action='append_const',
+			const='*', help="deform every outline and region layer")
+	parser.add_argument('--readable-names', action='store_true',
+			help="export the per-point values under names like "
+			"point12_window instead of short ids like _a3")
+	parser.add_argument('--budget', type=parsesize, metavar='SIZE',
+			help="largest output wanted, uncompressed, in bytes or with a "
+			"k, M or G suffix; checked before the output is expanded")
+	parser.add_argument('--over-budget', choices=('warn', 'abort', 'fallback'),
+			default='warn', help="when the output would exceed the budget, "
+			"warn and write it anyway (default), abort leaving the file "
+			"untouched, or fall back to the dedup or shared mode")
+	parser.add_argument('--cache', metavar='DIR',
+			help="keep the rigs built in DIR and reuse them for files whose "
+			"deformed layers and options were seen before")
+	parser.add_argument('--cache-size', type=parsesize, default=256 << 20,
+			metavar='SIZE', help="size the cache directory is kept under by "
+			"dropping the least recently used rigs, with a k, M or G suffix "
+			"(default 256M)")
+	parser.add_argument('--profile', metavar='REPORT',
+			help="write wall time, allocated memory and call counts of each "
+			"phase as JSON to REPORT; slows the run down, single files only")
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+			help="number of worker processes, building files in a batch or "
+			"layers of a single file (default: number of CPUs)")
+	parser.add_argument('--serve', nargs='?', const='', metavar='SOCKET',
+			help="stay running and process the files deformclient.py sends "
+			"over a Unix socket, sparing each run the startup time (default "
+			"socket %s)" % deformclient.socketpath())
+	return parser
+
+def main(argv=None):
+	"Process the files given on a command line, see makeparser()"
+	parser = makeparser()
+	args = parser.parse_args(argv)
+	if args.serve is not None:
+		serve(args.serve or deformclient.socketpath())
+		return
+	if not args.files:
+		parser.error("the following arguments are required: file")
+
+	paths = expandpaths(args.files)
+	if not paths:
+		print("No SIF files found:", " ".join(args.files))
+		raise SystemExit(1)
+
+	if len(paths) > 1:
+		if args.profile:
+			print("--profile is only used when processing a single file")
+			args.profile = None
+		# Files are spread over the workers, layers are built in-process
+		if processbatch(paths, args):
+			raise SystemExit(1)
+	else:
+		try:
+			processfile(paths[0], args, args.jobs)
+		except SystemExit:
+			raise
+		except:
+			traceback.print_exc()
+			raise SystemExit
 
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,195 @@
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# Value-node graph built by process() before any XML exists.
+#
+# Nodes are kept in one list and link to each other by index. A node can
+# only link to nodes created before it, so the list is always in dependency
+# order. There are four kinds of nodes:
+#   convert nodes  - tag and type as in SIF, links hold (link, id) pairs
+#   constants      - tag is the value type, links hold the value itself
+#   elements       - tag is None, links hold a value element taken from
+#                    the source file
+#   externs        - tag is 'extern', links and label hold the id of a
+#                    value already exported in the file
+# Unlabelled constants are interned, each distinct value is one node.
+# Labels name the nodes that become exported values, either a string or
+# a (pattern, index) pair formatted only when the graph is lowered to XML,
+# and only when readable names are wanted.
+
+# Links of each convert node with the type of constant each one takes,
+# None for the type of the node itself
+linktypes = {
+	'add': (('lhs', None), ('rhs', None), ('scalar', 'real')),
+	'subtract': (('lhs', None), ('rhs', None), ('scalar', 'real')),
+	'scale': (('link', None), ('scalar', 'real')),
+	'composite': (('x', 'real'), ('y', 'real')),
+	'reciprocal': (('link', 'real'), ('epsilon', 'real'), ('infinite', 'real')),
+	'vectorlength': (('vector', 'vector'),),
+	'vectorx': (('vector', 'vector'),),
+	'vectory': (('vector', 'vector'),),
+	'reference': (('link', None),),
+}
+
+class Node(object):
+	"Value node of a Graph"
+	__slots__ = ('tag', 'type', 'links', 'label')
+
+	def __init__(self, tag, type, links, label=None):
+		self.tag = tag
+		self.type = type
+		self.links = links
+		self.label = label
+
+class Graph(object):
+	"List of value nodes in dependency order, see above"
+	__slots__ = ('nodes', 'constants')
+
+	def __init__(self):
+		self.nodes = []
+		self.constants = {}
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def append(self, node):
+		self.nodes.append(node)
+		return len(self.nodes) - 1
+
+	def constant(self, type, value, label=None):
+		"Node holding a constant value"
+		if label is not None:
+			return self.append(Node(type, type, value, label))
+		key = (type, value)
+		if key not in self.constants:
+			self.constants[key] = self.append(Node(type, type, value))
+		return self.constants[key]
+
+	def element(self, elem, label=None):
+		"Node holding a value element of the source file"
+		return self.append(Node(None, None, elem, label))
+
+	def extern(self, name):
+		"Node standing for the value exported in the file under name"
+		return self.append(Node('extern', None, name, name))
+
+	def convert(self, tag, type, args, label=None):
+		"Convert node linking ids, or constants given as plain values"
+		links = []
+		for (link, linktype), arg in zip(linktypes[tag], args):
+			if not isinstance(arg, int):
+				arg = self.constant(linktype or type, arg)
+			links.append((link, arg))
+		return self.append(Node(tag, type, tuple(links), label))
+
+	def real(self, value=0.0, label=None):
+		return self.constant('real', value, label)
+
+	def vector(self, x=0.0, y=0.0, label=None):
+		return self.constant('vector', (x, y), label)
+
+	def add_real(self, lhs, rhs, scalar=1.0, label=None):
+		return self.convert('add', 'real', (lhs, rhs, scalar), label)
+
+	def add_vector(self, lhs, rhs, scalar=1.0, label=None):
+		return self.convert('add', 'vector', (lhs, rhs, scalar), label)
+
+	def substract_real(self, lhs, rhs, scalar=1.0, label=None):
+		return self.convert('subtract', 'real', (lhs, rhs, scalar), label)
+
+	def substract_vector(self, lhs, rhs, scalar=1.0, label=None):
+		return self.convert('subtract', 'vector', (lhs, rhs, scalar), label)
+
+	def composite(self, x, y, label=None):
+		return self.convert('composite', 'vector', (x, y), label)
+
+	def reciprocal(self, link, epsilon=0.000001, infinite=999999.0, label=None):
+		return self.convert('reciprocal', 'real', (link, epsilon, infinite), label)
+
+	def vectorlength(self, vector, label=None):
+		return self.convert('vectorlength', 'real', (vector,), label)
+
+	def vectorx(self, vector, label=None):
+		return self.convert('vectorx', 'real', (vector,), label)
+
+	def vectory(self, vector, label=None):
+		return self.convert('vectory', 'real', (vector,), label)
+
+	def scale_real(self, link, scalar=1.0, label=None):
+		return self.convert('scale', 'real', (link, scalar), label)
+
+	def scale_vector(self, link, scalar=1.0, label=None):
+		return self.convert('scale', 'vector', (link, scalar), label)
+
+	def reference_real(self, link, label=None):
+		return self.convert('reference', 'real', (link,), label)
+
+	def reference_vector(self, link, label=None):
+		return self.convert('reference', 'vector', (link,), label)
+
+	def graft(self, nodes, base):
+		"""Append nodes built on a graph holding the first base nodes of this one
+
+		Returns a dict mapping the ids the nodes had there to their ids here.
+		"""
+		remap = {}
+		for i, node in enumerate(nodes, base):
+			if node.tag in linktypes:
+				node.links = tuple((link, remap.get(j, j)) for link, j in node.links)
+			elif node.tag is not None and node.label is None:
+				remap[i] = self.constant(node.type, node.links)
+				continue
+			remap[i] = self.append(node)
+		return remap
+
+def labelname(label):
+	"Format the label of a node into its exported id"
+	if isinstance(label, tuple):
+		return label[0] % label[1:]
+	return label
+
+def base36(n):
+	"Short id for the number n, in digits and lowercase letters"
+	digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+	text = digits[n % 36]
+	while n >= 36:
+		n //= 36
+		text = digits[n % 36] + text
+	return text
+
+def usecounts(graph, roots):
+	"Count the links to each node reachable from the ids in roots"
+	counts = [0] * len(graph.nodes)
+	for i in roots:
+		counts[i] += 1
+	# Links always point back in the list, one backwards pass is enough
+	for i in range(len(graph.nodes) - 1, -1, -1):
+		node = graph.nodes[i]
+		if counts[i] and node.tag in linktypes:
+			for link, j in node.links:
+				counts[j] += 1
+	return counts
+
+def mergeduplicates(graph):
+	"""Make convert nodes with identical links share the first one of them
+
+	Returns a list mapping every id to the id of the node that replaces it.
+	Constants are already interned, so equal inputs have equal ids here.
+	"""
+	remap = list(range(len(graph.nodes)))
+	seen = {}
+	for i, node in enumerate(graph.nodes):
+		if node.tag not in linktypes:
+			continue
+		node.links = tuple((link, remap[j]) for link, j in node.links)
+		key = (node.tag, node.type, node.links)
+		if key in seen:
+			remap[i] = seen[key]
+		else:
+			seen[key] = i
+	return remap
@@ -8,18 +8,50 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
-import textwrap
-import xml.etree.ElementTree as ET
+from xmlbackend import ET
 
-nodedict = {
-		'real': ET.XML('<real value="0.0000000000" />'),
-		'vector': ET.XML(textwrap.dedent('''
+class TemplateDict(dict):
+	"Dictionary parsing the template source of a key on first access"
+
+	def __init__(self, sources):
+		dict.__init__(self)
+		self.sources = sources
+
+	def __missing__(self, key):
+		import textwrap
+		elem = ET.XML(textwrap.dedent(self.sources[key]))
+		self[key] = elem
+		return elem
+
+	def __contains__(self, key):
+		return key in self.sources
+
+	def __iter__(self):
+		return iter(self.sources)
+
+	def __len__(self):
+		return len(self.sources)
+
+	def keys(self):
+		return self.sources.keys()
+
+	def values(self):
+		return [self[key] for key in self.sources]
+
+	def items(self):
+		return [(key, self[key]) for key in self.sources]
+
+# Template sources, only parsed when used since the plugin is started anew on
+# every run and most templates are never needed
+templates = {
+		'real': '<real value="0.0000000000" />',
+		'vector': '''
 			<vector>
 			  <x>0.0000000000</x>
 			  <y>0.0000000000</y>
 			</vector>
-			''')),
-		'add_real': ET.XML(textwrap.dedent('''
+			''',
+		'add_real': '''
 			<add type="real">
 			  <lhs>
 			    <vector>
@@ -37,8 +69,8 @@ nodedict = {
 			    <real value="1.0000000000"/>
 			  </scalar>
 			</add>
-			''')),
-		'add_vector': ET.XML(textwrap.dedent('''
+			''',
+		'add_vector': '''
 			<add type="vector">
 			  <lhs>
 			    <vector>
@@ -56,8 +88,8 @@ nodedict = {
 			    <real value="1.0000000000"/>
 			  </scalar>
 			</add>
-			''')),
-		'composite': ET.XML(textwrap.dedent('''
+			''',
+		'composite': '''
 			<composite type="vector">
 			  <x>
 			    <real value="0.0000000000"/>
@@ -66,8 +98,8 @@ nodedict = {
 			    <real value="0.0000000000"/>
 			  </y>
 			</composite>
-			''')),
-		'substract_real': ET.XML(textwrap.dedent('''
+			''',
+		'substract_real': '''
 			<subtract type="real">
 			  <lhs>
 			    <real value="0.0000000000"/>
@@ -79,8 +111,8 @@ nodedict = {
 			    <real value="1.0000000000"/>
 			  </scalar>
 			</subtract>
-			''')),
-		'substract_vector': ET.XML(textwrap.dedent('''
+			''',
+		'substract_vector': '''
 			<subtract type="vector">
 			  <lhs>
 			    <vector>
@@ -98,8 +130,8 @@ nodedict = {
 			    <real value="1.0000000000"/>
 			  </scalar>
 			</subtract>
-			''')),
-		'reciprocal': ET.XML(textwrap.dedent('''
+			''',
+		'reciprocal': '''
 			<reciprocal type="real">
 			  <link>
 			    <real value="0.0000000000"/>
@@ -111,8 +143,8 @@ nodedict = {
 			    <real value="999999.0000000000"/>
 			  </infinite>
 			</reciprocal>
-			''')),
-		'vectorlength': ET.XML(textwrap.dedent('''
+			''',
+		'vectorlength': '''
 			<vectorlength type="real">
 			  <vector>
 			    <vector>
@@ -121,8 +153,8 @@ nodedict = {
 			    </vector>
 			  </vector>
 			</vectorlength>
-			''')),
-		'scale_real': ET.XML(textwrap.dedent('''
+			''',
+		'scale_real': '''
 			<scale type="real">
 			  <link>
 			    <real value="0.0000000000"/>
@@ -131,8 +163,8 @@ nodedict = {
 			    <real value="1.0000000000"/>
 			  </scalar>
 			</scale>
-			''')),
-		'scale_vector': ET.XML(textwrap.dedent('''
+			''',
+		'scale_vector': '''
 			<scale type="vector">
 			  <link>
 			    <vector>
@@ -144,8 +176,8 @@ nodedict = {
 			    <real value="1.0000000000"/>
 			  </scalar>
 			</scale>
-			''')),
-		'vectorx': ET.XML(textwrap.dedent('''
+			''',
+		'vectorx': '''
 			<vectorx type="real">
 			  <vector>
 			    <vector>
@@ -154,8 +186,8 @@ nodedict = {
 			    </vector>
 			  </vector>
 			</vectorx>
-			''')),
-		'vectory': ET.XML(textwrap.dedent('''
+			''',
+		'vectory': '''
 			<vectory type="real">
 			  <vector>
 			    <vector>
@@ -164,8 +196,8 @@ nodedict = {
 			    </vector>
 			  </vector>
 			</vectory>
-			''')),
-		'layer_outline': ET.XML(textwrap.dedent('''
+			''',
+		'layer_outline': '''
 			<layer type="outline" active="true" version="0.2" desc="NewSpline Outline">
 			  <param name="z_depth">
 			    <real value="0.0000000000"/>
@@ -270,8 +302,8 @@ nodedict = {
 			    <bool value="true"/>
 			  </param>
 			</layer>
-			''')),
-		'layer_rectangle': ET.XML(textwrap.dedent('''
+			''',
+		'layer_rectangle': '''
 			<layer type="rectangle" active="true" version="0.2" desc="Rectangle005">
 			  <param name="z_depth">
 			    <real value="0.0000000000"/>
@@ -309,8 +341,8 @@ nodedict = {
 			    <bool value="false"/>
 			  </param>
 			</layer>
-			''')),
-		'bline_entry': ET.XML(textwrap.dedent('''
+			''',
+		'bline_entry': '''
 			<entry>
 			  <composite type="bline_point">
 			    <point>
@@ -350,15 +382,15 @@ nodedict = {
 			    </t2>
 			  </composite>
 			</entry>
-			''')),
-		'reference_real': ET.XML(textwrap.dedent('''
+			''',
+		'reference_real': '''
 			<reference type="real">
 			  <link>
 			    <real value="0.0000000000" />
 			  </link>
 			</reference>
-			''')),
-		'reference_vector': ET.XML(textwrap.dedent('''
+			''',
+		'reference_vector': '''
 			<reference type="vector">
 			  <link>
 			    <vector>
@@ -367,5 +399,107 @@ nodedict = {
 			    </vector>
 			  </link>
 			</reference>
-			''')),
+			''',
 		}
+
+nodedict = TemplateDict(templates)
+
+#
+# Node builders
+#
+# Each builder creates the element of one template type directly, with the
+# given values. A link given as a string or an integer names an exported
+# node or graph node: no child element is created for it, instead an
+# (element, link, name) reference is returned for the caller to connect. A
+# link given as an element is used as is. Builders return (element, refs).
+#
+
+import math
+
+# Digits written after the decimal point for each type of constant, and
+# whether trailing zeros are dropped, see setprecision()
+defaultprecision = {'real': 10, 'angle': 6, 'vector': 10}
+precision = dict(defaultprecision)
+trimzeros = False
+
+def setprecision(digits=None, trim=False):
+	"Set the digits of given constant types, the others get their defaults"
+	global trimzeros
+	precision.update(defaultprecision)
+	precision.update(digits or {})
+	trimzeros = trim
+
+def trimnumber(text):
+	"Drop the trailing zeros of a decimal number, other text is kept as is"
+	if '.' not in text or not text.strip('-').replace('.', '', 1).isdigit():
+		return text
+	text = text.rstrip('0').rstrip('.')
+	return '0' if text in ('-0', '', '-') else text
+
+def _number(value, type):
+	"Decimal text of value, a non-zero value is never rounded to 0"
+	digits = precision[type]
+	text = '%.*f' % (digits, value)
+	while value and not float(text) and digits < 20:
+		digits += 1
+		text = '%.*f' % (digits, value)
+	return trimnumber(text) if trimzeros else text
+
+def _real(value):
+	return ET.Element('real', {'value': _number(value, 'real')})
+
+def _angle(value):
+	return ET.Element('angle', {'value': _number(value, 'angle')})
+
+def _bool(value):
+	return ET.Element('bool', {'value': 'true' if value else 'false'})
+
+def _vector(value):
+	elem = ET.Element('vector')
+	ET.SubElement(elem, 'x').text = _number(value[0], 'vector')
+	ET.SubElement(elem, 'y').text = _number(value[1], 'vector')
+	return elem
+
+def _tangent(value):
+	elem = ET.Element('radial_composite', {'type': 'vector'})
+	ET.SubElement(elem, 'radius').append(_real(math.hypot(value[0], value[1])))
+	ET.SubElement(elem, 'theta').append(
+			_angle(math.degrees(math.atan2(value[1], value[0]))))
+	return elem
+
+def _node(tag, type, links):
+	"Build linkable node from (link, value, constant builder) triples"
+	elem = ET.Element(tag, {'type': type})
+	refs = []
+	for link, value, build in links:
+		if isinstance(value, str) or (isinstance(value, int) and
+				not isinstance(value, bool)):
+			refs.append((elem, link, value))
+		elif ET.iselement(value):
+			ET.SubElement(elem, link).append(value)
+		else:
+			ET.SubElement(elem, link).append(build(value))
+	return elem, refs
+
+def constant(type, value):
+	"Element of a constant value of given type"
+	return {'real': _real, 'angle': _angle, 'bool': _bool, 'vector': _vector}[type](value)
+
+def animated_vector(waypoints, interpolation='linear'):
+	"Animated vector from (time, value) pairs, times as SIF time strings"
+	elem = ET.Element('animated', {'type': 'vector'})
+	for time, value in waypoints:
+		waypoint = ET.SubElement(elem, 'waypoint', {'time': time,
+				'before': interpolation, 'after': interpolation})
+		waypoint.append(_vector(value))
+	return elem, []
+
+def bline_entry(point=(0.0, 0.0), t1=(0.0, 0.0), t2=(0.0, 0.0), width=1.0,
+		origin=0.5, split=False):
+	elem, refs = _node('composite', 'bline_point', (
+			('point', point, _vector), ('width', width, _real),
+			('origin', origin, _real), ('split', split, _bool),
+			('t1', t1, _tangent), ('t2', t2, _tangent)))
+	entry = ET.Element('entry')
+	entry.append(elem)
+	return entry, refs
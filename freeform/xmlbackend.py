@@ -0,0 +1,44 @@
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# XML backend shared by the scripts: lxml when it is installed, for its
+# faster parsing and serialization, xml.etree.ElementTree otherwise. Set
+# FREEFORM_DEFORM_XML=etree to use ElementTree with lxml installed.
+#
+# Both are used through the ElementTree API as ET. Where they differ:
+# an lxml element has only one parent, so inserting it elsewhere moves
+# it, it can't be pickled, and its Python object is made on access and
+# only lives as long as it is referenced.
+
+import os
+
+ET = None
+if os.environ.get('FREEFORM_DEFORM_XML', 'lxml') != 'etree':
+	try:
+		from lxml import etree as ET
+	except ImportError:
+		pass
+if ET is None:
+	import xml.etree.ElementTree as ET
+
+lxml = ET.__name__ == 'lxml.etree'
+
+def parse(source):
+	"Parse a SIF file, leaving out comments and processing instructions"
+	if lxml:
+		# Without huge_tree, lxml refuses the deep or long files rigs make
+		return ET.parse(source, ET.XMLParser(remove_comments=True,
+				remove_pis=True, huge_tree=True))
+	return ET.parse(source)
+
+def parents(root, elems):
+	"Parent element of each of elems in the tree under root"
+	if lxml:
+		return [elem.getparent() for elem in elems]
+	parent = dict((child, p) for p in root.iter() for child in p)
+	return [parent[elem] for elem in elems]
@@ -0,0 +1,198 @@
+#
+# Copyright (c) 2013 by Gerald Young <supersayoyin@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# Regression tests running freeform-deform.py and evaluator.py as the
+# plugin and users do, on copies of the sample files.
+
+import os
+import sys
+import math
+import shutil
+import socket
+import subprocess
+import threading
+import importlib.util
+import xml.etree.ElementTree as ET
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+scripts = os.path.join(os.path.dirname(here), 'freeform')
+samples = os.path.join(os.path.dirname(here), 'samples')
+
+def sample(tmp_path, name='simplespline.sif'):
+	"Copy of a sample file in tmp_path"
+	path = str(tmp_path / name)
+	shutil.copy(os.path.join(samples, name), path)
+	return path
+
+def loadscript():
+	"freeform-deform.py loaded as a module"
+	if scripts not in sys.path:
+		sys.path.insert(0, scripts)
+	spec = importlib.util.spec_from_file_location('freeform_deform',
+			os.path.join(scripts, 'freeform-deform.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def deform(*args):
+	"Run freeform-deform.py, returning its output"
+	return subprocess.check_output([sys.executable,
+			os.path.join(scripts, 'freeform-deform.py')] + list(args),
+			stderr=subprocess.STDOUT).decode('utf-8')
+
+def evaluate(path):
+	"Deformed vertices of a processed file, as rows of numbers"
+	output = subprocess.check_output([sys.executable,
+			os.path.join(scripts, 'evaluator.py'), path],
+			stderr=subprocess.DEVNULL).decode('utf-8')
+	return [[float(x) for x in line.split()] for line in output.splitlines()]
+
+def test_low_precision_is_finite(tmp_path):
+	path = sample(tmp_path)
+	deform('--precision', 'real=3', path)
+	rows = evaluate(path)
+	assert rows
+	assert all(math.isfinite(x) for row in rows for x in row)
+
+def test_simplify_linked_first_vertex(tmp_path):
+	path = sample(tmp_path)
+	tree = ET.parse(path)
+	point = tree.find('.//bline/entry/composite/point')
+	vector = point.find('vector')
+	composite = ET.Element('composite', {'type': 'vector'})
+	for axis in ('x', 'y'):
+		ET.SubElement(ET.SubElement(composite, axis), 'real',
+				{'value': vector.find(axis).text})
+	point.remove(vector)
+	point.append(composite)
+	tree.write(path)
+	deform('--simplify', '0.01', path)
+	rows = evaluate(path)
+	assert rows
+	assert all(math.isfinite(x) for row in rows for x in row)
+
+def test_bake_simplified_rig(tmp_path):
+	path = sample(tmp_path)
+	deform('--simplify', '0.5', path)
+	# Move the control points apart, with every copy of their linked vectors
+	tree = ET.parse(path)
+	root = tree.getroot()
+	control = [l for l in root.findall('layer') if l.get('desc') == 'ControlBezier'][0]
+	places = [(-1.5, 0.3), (0.2, 1.1), (1.7, -0.4)]
+	points = control.findall("param[@name='bline']/bline/entry/composite/point/vector")
+	for vector, (x, y) in zip(points, places):
+		for elem in root.iter('vector'):
+			if elem.get('guid') == vector.get('guid'):
+				elem.find('x').text = repr(x)
+				elem.find('y').text = repr(y)
+	tree.write(path)
+	rows = evaluate(path)
+	deform('--mode', 'bake', path)
+	deformed = [l for l in ET.parse(path).getroot().findall('layer')
+			if l.get('desc') == 'Deformed'][0]
+	vertices = [(float(v.find('x').text), float(v.find('y').text))
+			for v in deformed.findall("param[@name='bline']/bline/entry/composite/point/vector")]
+	assert len(vertices) == len(rows) < 5
+	for (x, y), row in zip(vertices, rows):
+		assert abs(x - row[0]) < 1e-6 and abs(y - row[1]) < 1e-6
+
+def test_predicted_size_of_rigged_file(tmp_path):
+	script = loadscript()
+	path = sample(tmp_path)
+	tree = script.xmlbackend.parse(path)
+	script.process(tree, stream=True)
+	assert script.readrig(tree.getroot()) is not None
+	nodes, size = script.predictsize(tree.getroot())
+	with open(path, 'wb') as f:
+		script.writesif(tree, f)
+	assert size == os.path.getsize(path)
+
+def test_canvas_without_layers(tmp_path):
+	path = str(tmp_path / 'empty.sif')
+	with open(path, 'w') as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+				'<canvas version="0.5" width="480" height="270" fps="24">\n</canvas>\n')
+	with open(path, 'rb') as f:
+		before = f.read()
+	assert 'No layers to rig' in deform(path)
+	with open(path, 'rb') as f:
+		assert f.read() == before
+
+def test_polyline_path(tmp_path):
+	path = sample(tmp_path)
+	tree = ET.parse(path)
+	root = tree.getroot()
+	layer = root.find('layer')
+	source = [(float(v.find('x').text), float(v.find('y').text))
+			for v in layer.findall("param[@name='bline']/bline/entry/composite/point/vector")]
+	# A straight path of clicked corners, without tangents, along the window
+	pathlayer = ET.fromstring(ET.tostring(layer))
+	pathlayer.set('desc', 'Path')
+	bline = pathlayer.find("param[@name='bline']/bline")
+	bline.set('loop', 'false')
+	entries = bline.findall('entry')
+	for entry in entries[3:]:
+		bline.remove(entry)
+	for entry, x in zip(entries, (0.0, 0.5, 1.0)):
+		composite = entry.find('composite')
+		composite.find('point/vector/x').text = repr(x)
+		composite.find('point/vector/y').text = '0.0'
+		for tangent in composite.iter('radius'):
+			tangent.find('real').set('value', '0.0')
+	root.insert(list(root).index(layer), pathlayer)
+	tree.write(path)
+	deform('--path', 'Path', path)
+	rows = evaluate(path)
+	assert len(rows) == len(source)
+	for (x, y), row in zip(source, rows):
+		assert abs(x - row[0]) < 1e-6 and abs(y - row[1]) < 1e-6
+
+def test_failed_write_keeps_source(tmp_path):
+	script = loadscript()
+	path = sample(tmp_path)
+	with open(path, 'rb') as f:
+		before = f.read()
+	def failing(tree, f):
+		f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<canvas')
+		raise KeyboardInterrupt
+	script.writesif = failing
+	options = script.makeparser().parse_args([path])
+	with pytest.raises(KeyboardInterrupt):
+		script.processfile(path, options)
+	with open(path, 'rb') as f:
+		assert f.read() == before
+	assert os.listdir(str(tmp_path)) == ['simplespline.sif']
+
+def test_client_trusts_only_own_socket(tmp_path):
+	if scripts not in sys.path:
+		sys.path.insert(0, scripts)
+	import deformclient
+	path = str(tmp_path / 'daemon.sock')
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(path)
+	server.listen(1)
+	def answer():
+		# Reports success without processing anything
+		connection = server.accept()[0]
+		while connection.recv(65536):
+			pass
+		connection.sendall(b'{"status": 0, "output": ""}')
+		connection.close()
+	thread = threading.Thread(target=answer)
+	thread.start()
+	try:
+		if os.getuid() == 0:
+			os.chown(path, 12345, -1)
+			assert deformclient.request(['file.sif'], path) is None
+			os.chown(path, 0, -1)
+		assert deformclient.request(['file.sif'], path) == (0, '')
+	finally:
+		thread.join(5)
+		server.close()